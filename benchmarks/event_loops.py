@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import importlib.util
+import multiprocessing
+from pathlib import Path
+
+from anyio import create_task_group, run
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'graphical_app'))
+
+import reading  # noqa: E402
+import history  # noqa: E402
+import network  # noqa: E402
+
+
+HISTORY_SCRIPT = (
+    Path(__file__).resolve().parent.parent / 'console_app' / 'minechat-message-history.py'
+)
+# "\n[дд.мм.гг чч:мм] " перед сообщением и "\n" после
+HISTORY_LINE_OVERHEAD = 19
+
+
+def get_settings():
+    parser = argparse.ArgumentParser(
+        description='Compare asyncio and uvloop on reading a flood of chat messages',
+    )
+    parser.add_argument(
+        "-n",
+        "--messages",
+        type=int,
+        default=200000,
+        help="How many messages the server sends on every connection"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=80,
+        help="Size of chat messages in bytes"
+    )
+    parser.add_argument(
+        "-r",
+        "--rounds",
+        type=int,
+        default=3,
+        help="How many times to run every benchmark, the best run is printed"
+    )
+    return parser.parse_args()
+
+
+def make_lines(count, size):
+    # строки разные, иначе фильтр повторов после переподключения их выкинет
+    return b''.join(
+        f'{number:010d} '.ljust(size - 1, 'x').encode() + b'\n'
+        for number in range(count)
+    )
+
+
+def serve_flood(lines, port_pipe):
+    # сервер живёт в отдельном процессе, чтобы его работа не попала
+    # в процессорное время клиента
+    async def handle_connection(reader, writer):
+        writer.write(lines)
+        await writer.drain()
+        # соединение не закрываем, иначе клиент уйдёт переподключаться
+        await reader.read()
+        writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle_connection, '127.0.0.1', 0)
+        port_pipe.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def load_history_script():
+    # в имени файла дефисы, обычный import его не найдёт
+    spec = importlib.util.spec_from_file_location('message_history', HISTORY_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CountingQueue:
+    # Притворяется очередью и только считает сообщения
+    def __init__(self, expected=None):
+        self.count = 0
+        self.expected = expected
+        self.done = asyncio.Event()
+
+    async def put(self, message):
+        self.put_nowait(message)
+
+    def put_nowait(self, message):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+async def measure_read_messages(port, expected, result):
+    messages_queue = CountingQueue(expected)
+    history_message_queue = CountingQueue()
+    status_updates_queue = CountingQueue()
+
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            reading.read_messages,
+            messages_queue,
+            history_message_queue,
+            '127.0.0.1',
+            port,
+            status_updates_queue,
+            history.ReplayFilter(1000),
+            network.LivenessMonitor(),
+            0,
+            network.Backoff()
+        )
+        await messages_queue.done.wait()
+        task_group.cancel_scope.cancel()
+
+    result['seconds'] = time.perf_counter() - started_at
+    result['cpu'] = time.process_time() - cpu_started_at
+
+
+async def measure_get_chat_messages(history_script, port, expected_size, result):
+    with tempfile.TemporaryDirectory() as directory:
+        history_path = os.path.join(directory, 'history.txt')
+        settings = argparse.Namespace(
+            endpoint=[history_script.parse_endpoint(f'127.0.0.1:{port}')],
+            merge=False,
+            quiet=True,
+            history_path=history_path,
+        )
+
+        started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+
+        task = asyncio.create_task(history_script.get_chat_messages(settings))
+        while not os.path.exists(history_path) \
+                or os.path.getsize(history_path) < expected_size:
+            await asyncio.sleep(0.01)
+
+        result['seconds'] = time.perf_counter() - started_at
+        result['cpu'] = time.process_time() - cpu_started_at
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def print_result(name, event_loop, results, messages):
+    best = min(results, key=lambda result: result['seconds'])
+    print(
+        f'{name:18} {event_loop:8} '
+        f'{messages / best["seconds"]:>12,.0f} msg/s '
+        f'{best["cpu"] / messages * 1e6:>8.2f} us CPU/msg'
+    )
+
+
+def main_benchmark():
+    settings = get_settings()
+    history_script = load_history_script()
+
+    lines = make_lines(settings.messages, settings.size)
+    # сообщение сохраняется без перевода строки, которым кончалось
+    expected_size = settings.messages * (settings.size - 1 + HISTORY_LINE_OVERHEAD)
+
+    port_pipe, server_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=serve_flood, args=(lines, server_pipe), daemon=True)
+    server.start()
+    port = port_pipe.recv()
+
+    event_loops = ['asyncio']
+    if network.choose_event_loop('auto') == 'uvloop':
+        event_loops.append('uvloop')
+    else:
+        print('uvloop is not installed, only asyncio is measured')
+
+    try:
+        for event_loop in event_loops:
+            results = []
+            for _ in range(settings.rounds):
+                result = {}
+                run(
+                    measure_read_messages,
+                    port,
+                    settings.messages,
+                    result,
+                    backend_options=network.get_backend_options(event_loop)
+                )
+                results.append(result)
+            print_result('read_messages', event_loop, results, settings.messages)
+
+            results = []
+            for _ in range(settings.rounds):
+                result = {}
+                network.run_coroutine(
+                    measure_get_chat_messages(
+                        history_script, port, expected_size, result),
+                    event_loop
+                )
+                results.append(result)
+            print_result('get_chat_messages', event_loop, results, settings.messages)
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,248 @@
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from collections import deque
+
+
+GREETING = 'Hello %username%! Enter your personal hash or leave it empty to create new account.\n'
+NICKNAME_PROMPT = 'Enter preferred nickname below:\n'
+WELCOME = 'Welcome to chat! Post your message below. End it with an empty line.\n'
+ACKNOWLEDGEMENT = 'Message send. Write more, our chat is fun.\n'
+
+
+class FakeChatServer:
+    def __init__(
+            self,
+            host='127.0.0.1',
+            read_port=0,
+            write_port=0,
+            handshake_latency=0,
+            message_rate=0,
+            message_size=60,
+            latency=0,
+            disconnect_interval=0,
+            backlog=0):
+
+        self.host = host
+        self.read_port = read_port
+        self.write_port = write_port
+        self.handshake_latency = handshake_latency
+        self.message_rate = message_rate
+        self.message_size = message_size
+        self.latency = latency
+        self.disconnect_interval = disconnect_interval
+        self.backlog = deque(maxlen=backlog)
+        self.background_tasks = []
+
+        self.accounts = {}
+        self.read_connections = set()
+        self.write_connections = set()
+        self.posted_messages = asyncio.Queue()
+        self.servers = []
+        self.handlers = set()
+
+    async def start(self):
+        read_server = await asyncio.start_server(
+            self.handle_read_connection, self.host, self.read_port)
+        write_server = await asyncio.start_server(
+            self.handle_write_connection, self.host, self.write_port)
+
+        self.servers = [read_server, write_server]
+        self.read_port = read_server.sockets[0].getsockname()[1]
+        self.write_port = write_server.sockets[0].getsockname()[1]
+
+        if self.message_rate:
+            self.background_tasks.append(
+                asyncio.create_task(self.generate_messages()))
+        if self.disconnect_interval:
+            self.background_tasks.append(
+                asyncio.create_task(self.disconnect_periodically()))
+
+    async def stop(self):
+        for task in self.background_tasks:
+            task.cancel()
+        for server in self.servers:
+            server.close()
+        self.drop_connections()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    def drop_connections(self, read=True, write=True):
+        connections = set()
+        if read:
+            connections |= self.read_connections
+        if write:
+            connections |= self.write_connections
+
+        for writer in connections:
+            writer.transport.abort()
+
+    def register(self, nickname):
+        account_hash = str(uuid.uuid4())
+        self.accounts[account_hash] = nickname
+        return {'nickname': nickname, 'account_hash': account_hash}
+
+    def make_message(self, number):
+        # время отправки в сообщении нужно, чтобы клиент посчитал задержку
+        text = f'Bot{number % 10}: {time.perf_counter():.6f} '
+        return text.ljust(self.message_size - 1, 'x') + '\n'
+
+    def broadcast(self, line):
+        self.backlog.append(line)
+        data = line.encode()
+
+        for writer in list(self.read_connections):
+            if self.latency:
+                asyncio.get_running_loop().call_later(
+                    self.latency, self.deliver, writer, data)
+            else:
+                writer.write(data)
+
+    def deliver(self, writer, data):
+        if not writer.is_closing():
+            writer.write(data)
+
+    async def generate_messages(self, tick=0.01):
+        number = 0
+        started_at = time.monotonic()
+
+        while True:
+            await asyncio.sleep(tick)
+            expected = int((time.monotonic() - started_at) * self.message_rate)
+            while number < expected:
+                self.broadcast(self.make_message(number))
+                number += 1
+
+    async def disconnect_periodically(self):
+        while True:
+            await asyncio.sleep(self.disconnect_interval)
+            self.drop_connections()
+
+    async def handle_read_connection(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        self.read_connections.add(writer)
+        try:
+            # как и настоящий сервер, сначала отдаём последние сообщения
+            writer.write(''.join(self.backlog).encode())
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self.handlers.discard(asyncio.current_task())
+            self.read_connections.discard(writer)
+            writer.close()
+
+    async def handle_write_connection(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        self.write_connections.add(writer)
+        try:
+            await asyncio.sleep(self.handshake_latency)
+            writer.write(GREETING.encode())
+
+            account_hash = (await reader.readline()).decode().strip()
+            await asyncio.sleep(self.handshake_latency)
+
+            if not account_hash:
+                writer.write(NICKNAME_PROMPT.encode())
+                nickname = (await reader.readline()).decode().strip()
+                writer.write((json.dumps(self.register(nickname)) + '\n').encode())
+                return
+
+            if account_hash not in self.accounts:
+                writer.write(b'null\n')
+                return
+
+            nickname = self.accounts[account_hash]
+            account = {'nickname': nickname, 'account_hash': account_hash}
+            writer.write((json.dumps(account) + '\n' + WELCOME).encode())
+
+            message_lines = []
+            while line := await reader.readline():
+                line = line.decode().strip()
+                if line:
+                    message_lines.append(line)
+                    continue
+
+                if message_lines:
+                    message = ' '.join(message_lines)
+                    self.posted_messages.put_nowait((writer, message))
+                    self.broadcast(f'{nickname}: {message}\n')
+                    message_lines = []
+                writer.write(ACKNOWLEDGEMENT.encode())
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self.handlers.discard(asyncio.current_task())
+            self.write_connections.discard(writer)
+            writer.close()
+
+
+def get_settings():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the minechat server',
+    )
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--read_port", type=int, default=5000)
+    parser.add_argument("--write_port", type=int, default=5050)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1,
+        help="Generated chat messages per second"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=60,
+        help="Size of generated messages in bytes"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Delay before delivering every message to readers, seconds"
+    )
+    parser.add_argument(
+        "--handshake_latency",
+        type=float,
+        default=0,
+        help="Delay before every handshake step, seconds"
+    )
+    parser.add_argument(
+        "--disconnect_interval",
+        type=float,
+        default=0,
+        help="Drop all connections every this many seconds. 0 disables"
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=100,
+        help="How many last messages to replay to new readers"
+    )
+    return parser.parse_args()
+
+
+async def main():
+    settings = get_settings()
+    server = FakeChatServer(
+        settings.host,
+        settings.read_port,
+        settings.write_port,
+        handshake_latency=settings.handshake_latency,
+        message_rate=settings.rate,
+        message_size=settings.size,
+        latency=settings.latency,
+        disconnect_interval=settings.disconnect_interval,
+        backlog=settings.backlog,
+    )
+    await server.start()
+    print(f'Read port {server.read_port}, write port {server.write_port}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
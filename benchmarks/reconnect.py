@@ -0,0 +1,175 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+from anyio import create_task_group, run
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'graphical_app'))
+
+import events  # noqa: E402
+import main  # noqa: E402
+import reading  # noqa: E402
+import outbox  # noqa: E402
+import history  # noqa: E402
+from fake_server import FakeChatServer  # noqa: E402
+
+
+def get_settings():
+    parser = argparse.ArgumentParser(
+        description='Time to recover after the server drops a connection',
+    )
+    parser.add_argument(
+        "-r",
+        "--rounds",
+        type=int,
+        default=10,
+        help="How many times to drop each connection"
+    )
+    parser.add_argument(
+        "-l",
+        "--handshake_latency",
+        type=float,
+        default=0.05,
+        help="Delay the fake server adds to every handshake step, seconds"
+    )
+    return parser.parse_args()
+
+
+async def wait_for_status(status_updates_queue, expected):
+    while True:
+        status = await status_updates_queue.get()
+        if status == expected:
+            return
+
+
+async def measure_read_recovery(server, rounds, logger):
+    messages_queue = asyncio.Queue()
+    history_message_queue = asyncio.Queue()
+    status_updates_queue = asyncio.Queue()
+    recoveries = []
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            reading.keep_reading,
+            server.host,
+            server.read_port,
+            messages_queue,
+            history_message_queue,
+            status_updates_queue,
+            history.ReplayFilter(0),
+            logger,
+            10,
+            0
+        )
+
+        for _ in range(rounds):
+            await wait_for_status(
+                status_updates_queue, events.ReadConnectionStateChanged.ESTABLISHED)
+
+            dropped_at = time.perf_counter()
+            server.drop_connections(write=False)
+
+            while messages_queue.empty():
+                server.broadcast('Benchmark: are you there?\n')
+                await asyncio.sleep(0.001)
+            recoveries.append(time.perf_counter() - dropped_at)
+
+            while not messages_queue.empty():
+                messages_queue.get_nowait()
+
+        task_group.cancel_scope.cancel()
+
+    return recoveries
+
+
+async def measure_send_recovery(server, rounds, use_standby, logger):
+    account = server.register('benchmark')
+    sending_queue = asyncio.Queue()
+    status_updates_queue = asyncio.Queue()
+    recoveries = []
+
+    directory = tempfile.TemporaryDirectory()
+    chat_outbox = outbox.Outbox(os.path.join(directory.name, 'outbox.jsonl'))
+    chat_outbox.load()
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            main.keep_sending,
+            server.host,
+            server.write_port,
+            account['account_hash'],
+            sending_queue,
+            status_updates_queue,
+            chat_outbox,
+            logger,
+            10,
+            0,
+            0,
+            use_standby
+        )
+
+        for round_number in range(rounds):
+            # даём запасному соединению время авторизоваться
+            await asyncio.sleep(server.handshake_latency * 4)
+
+            sending_queue.put_nowait(
+                chat_outbox.append(f'before drop {round_number}'))
+            writer, _ = await server.posted_messages.get()
+
+            dropped_at = time.perf_counter()
+            writer.transport.abort()
+
+            await wait_for_status(
+                status_updates_queue, events.SendingConnectionStateChanged.CLOSED)
+            sending_queue.put_nowait(
+                chat_outbox.append(f'after drop {round_number}'))
+            await server.posted_messages.get()
+            recoveries.append(time.perf_counter() - dropped_at)
+
+        task_group.cancel_scope.cancel()
+
+    chat_outbox.close()
+    directory.cleanup()
+    return recoveries
+
+
+def print_result(name, recoveries):
+    recoveries = [recovery * 1000 for recovery in recoveries]
+    print(
+        f'{name:<22} recovery p50 {statistics.median(recoveries):8.1f} ms   '
+        f'max {max(recoveries):8.1f} ms'
+    )
+
+
+async def run_benchmark():
+    settings = get_settings()
+    logger = logging.getLogger('watchdog')
+    logger.setLevel(logging.ERROR)
+
+    server = FakeChatServer(handshake_latency=settings.handshake_latency)
+    await server.start()
+
+    print_result(
+        'read',
+        await measure_read_recovery(server, settings.rounds, logger)
+    )
+    print_result(
+        'send',
+        await measure_send_recovery(server, settings.rounds, False, logger)
+    )
+    print_result(
+        'send with standby',
+        await measure_send_recovery(server, settings.rounds, True, logger)
+    )
+
+    await server.stop()
+
+
+if __name__ == '__main__':
+    run(run_benchmark)
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+from fake_server import FakeChatServer
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# скрипт и нужно ли ему окно
+ENTRY_POINTS = (
+    ('graphical_app/main.py', True),
+    ('graphical_app/relay.py', False),
+    ('graphical_app/registration.py', False),
+    ('graphical_app/store.py', False),
+    ('graphical_app/search.py', False),
+    ('console_app/minechat-message-history.py', False),
+    ('console_app/minechat-interact.py', False),
+)
+HISTORY_SCRIPT = ROOT / 'console_app' / 'minechat-message-history.py'
+
+
+def get_settings():
+    parser = argparse.ArgumentParser(
+        description='Cold start of every entry point: import time from '
+                    '-X importtime and time to the first saved message',
+    )
+    parser.add_argument(
+        "-r",
+        "--rounds",
+        type=int,
+        default=5,
+        help="How many times to start every script, the median is printed"
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=3,
+        help="How many heaviest imports to show for every script"
+    )
+    return parser.parse_args()
+
+
+def parse_importtime(output):
+    # строки вида "import time:  self [us] | cumulative | <отступ>модуль"
+    modules = {}
+    top_level = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        module = name.strip()
+        modules[module] = int(cumulative)
+        # модули, которые импортировал сам скрипт, идут с одним отступом
+        if len(name) - len(name.lstrip()) == 1:
+            top_level[module] = int(cumulative)
+
+    return modules, top_level
+
+
+def measure_startup(script, rounds):
+    # --help разбирает настройки и выходит: это всё, что скрипт делает
+    # до первого подключения
+    wall_times = []
+    import_times = []
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', str(ROOT / script), '--help'],
+            cwd=(ROOT / script).parent,
+            capture_output=True,
+            text=True,
+        )
+        wall_times.append(time.perf_counter() - started_at)
+
+        modules, top_level = parse_importtime(process.stderr)
+        import_times.append(sum(top_level.values()) / 1e6)
+
+    return statistics.median(wall_times), statistics.median(import_times), modules, top_level
+
+
+async def measure_first_message(rounds):
+    server = FakeChatServer(message_rate=100, backlog=100)
+    await server.start()
+    # сервер отдаёт последние сообщения сразу при подключении
+    await asyncio.sleep(0.2)
+
+    first_message_times = []
+    with tempfile.TemporaryDirectory() as directory:
+        for number in range(rounds):
+            history_path = os.path.join(directory, f'history{number}.txt')
+            started_at = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable,
+                str(HISTORY_SCRIPT),
+                '-e', f'{server.host}:{server.read_port}',
+                '-hp', history_path,
+                '-q',
+                cwd=HISTORY_SCRIPT.parent,
+            )
+
+            while not os.path.exists(history_path) or not os.path.getsize(history_path):
+                await asyncio.sleep(0.001)
+            first_message_times.append(time.perf_counter() - started_at)
+
+            process.terminate()
+            await process.wait()
+
+    await server.stop()
+    return statistics.median(first_message_times)
+
+
+def main():
+    settings = get_settings()
+    tk_in_headless = []
+
+    for script, needs_tk in ENTRY_POINTS:
+        wall_time, import_time, modules, top_level = measure_startup(
+            script, settings.rounds)
+        heaviest = sorted(top_level.items(), key=lambda item: -item[1])[:settings.top]
+        uses_tk = 'tkinter' in modules
+
+        print(
+            f'{script:42} start {wall_time * 1000:7.1f} ms   '
+            f'imports {import_time * 1000:6.1f} ms   '
+            f'modules {len(modules):4}   tkinter {"yes" if uses_tk else "no"}'
+        )
+        print('    ' + ', '.join(
+            f'{module} {cumulative / 1000:.1f} ms' for module, cumulative in heaviest))
+
+        if uses_tk and not needs_tk:
+            tk_in_headless.append(script)
+
+    first_message_time = asyncio.run(measure_first_message(settings.rounds))
+    print(
+        f'{"first message saved by the history script":42} '
+        f'{first_message_time * 1000:7.1f} ms'
+    )
+
+    if tk_in_headless:
+        print(f'tkinter is imported without a window: {", ".join(tk_in_headless)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+from anyio import create_task_group, run
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'graphical_app'))
+
+import main  # noqa: E402
+import reading  # noqa: E402
+import outbox  # noqa: E402
+import history  # noqa: E402
+import network  # noqa: E402
+import registration  # noqa: E402
+from fake_server import FakeChatServer  # noqa: E402
+from reconnect import measure_read_recovery, measure_send_recovery  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+def get_settings():
+    parser = argparse.ArgumentParser(
+        description='Load and latency benchmarks against a local fake minechat server',
+    )
+    parser.add_argument(
+        "-s",
+        "--seconds",
+        type=float,
+        default=5,
+        help="Duration of the read benchmark"
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=20000,
+        help="Messages per second the fake server sends to readers"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=60,
+        help="Size of chat messages in bytes"
+    )
+    parser.add_argument(
+        "-n",
+        "--messages",
+        type=int,
+        default=50000,
+        help="How many messages to send and save"
+    )
+    parser.add_argument(
+        "--registrations",
+        type=int,
+        default=200,
+        help="How many accounts to register"
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=5,
+        help="How many times to drop connections in the reconnect benchmark"
+    )
+    return parser.parse_args()
+
+
+def get_peak_memory():
+    if resource is None:
+        return 0
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_memory if sys.platform == 'darwin' else peak_memory * 1024
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def print_result(name, count, seconds, latencies=(), memory_growth=0):
+    line = f'{name:<10} {count / seconds:12.0f} msg/s'
+    if latencies:
+        latencies = [latency * 1000 for latency in latencies]
+        line += (
+            f'   p50 {statistics.median(latencies):8.2f} ms'
+            f'   p99 {percentile(latencies, 0.99):8.2f} ms'
+        )
+    line += f'   memory +{memory_growth / 1024 / 1024:.1f} MB'
+    print(line)
+
+
+async def benchmark_read(settings):
+    server = FakeChatServer(message_rate=settings.rate, message_size=settings.size)
+    await server.start()
+
+    messages_queue = asyncio.Queue()
+    history_message_queue = asyncio.Queue()
+    status_updates_queue = asyncio.Queue()
+    latencies = []
+    memory_before = get_peak_memory()
+
+    async def consume_messages():
+        while True:
+            message = await messages_queue.get()
+            received_at = time.perf_counter()
+            latencies.append(received_at - float(message.text.split()[1]))
+            history_message_queue.get_nowait()
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            reading.read_messages,
+            messages_queue,
+            history_message_queue,
+            server.host,
+            server.read_port,
+            status_updates_queue,
+            history.ReplayFilter(1000),
+            network.LivenessMonitor(),
+            0,
+            network.Backoff()
+        )
+        task_group.start_soon(consume_messages)
+
+        await asyncio.sleep(settings.seconds)
+        task_group.cancel_scope.cancel()
+
+    await server.stop()
+    print_result(
+        'read',
+        len(latencies),
+        settings.seconds,
+        latencies,
+        get_peak_memory() - memory_before
+    )
+
+
+async def benchmark_send(settings):
+    server = FakeChatServer()
+    await server.start()
+    account = server.register('benchmark')
+
+    directory = tempfile.TemporaryDirectory()
+    chat_outbox = outbox.Outbox(os.path.join(directory.name, 'outbox.jsonl'))
+    chat_outbox.load()
+
+    sending_queue = asyncio.Queue()
+    queued_at = {}
+    latencies = []
+    memory_before = get_peak_memory()
+
+    post_reader, post_writer, _ = await main.open_sending_connection(
+        server.host, server.write_port, account['account_hash'], 0)
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            main.send_messages,
+            post_reader,
+            post_writer,
+            sending_queue,
+            asyncio.Queue(),
+            chat_outbox,
+            network.LivenessMonitor(),
+            0
+        )
+
+        started_at = time.perf_counter()
+        for number in range(settings.messages):
+            text = f'message {number}'
+            queued_at[text] = time.perf_counter()
+            sending_queue.put_nowait(chat_outbox.append(text))
+
+        for _ in range(settings.messages):
+            _, text = await server.posted_messages.get()
+            latencies.append(time.perf_counter() - queued_at[text])
+
+        seconds = time.perf_counter() - started_at
+        task_group.cancel_scope.cancel()
+
+    post_writer.close()
+    chat_outbox.close()
+    directory.cleanup()
+    await server.stop()
+    print_result(
+        'send',
+        settings.messages,
+        seconds,
+        latencies,
+        get_peak_memory() - memory_before
+    )
+
+
+async def benchmark_save(settings):
+    history_message_queue = asyncio.Queue()
+    message = history.ChatMessage.from_text('Bot: ' + 'x' * (settings.size - 6))
+    memory_before = get_peak_memory()
+
+    with tempfile.TemporaryDirectory() as directory:
+        history_path = os.path.join(directory, 'history.txt')
+        open(history_path, 'w').close()
+        expected_size = len(message.raw) * settings.messages
+
+        async with create_task_group() as task_group:
+            task_group.start_soon(
+                main.save_messages,
+                history_message_queue,
+                history_path,
+                logging.getLogger('history')
+            )
+
+            started_at = time.perf_counter()
+            for _ in range(settings.messages):
+                await history_message_queue.put(message)
+
+            while os.path.getsize(history_path) < expected_size:
+                await asyncio.sleep(0.001)
+
+            seconds = time.perf_counter() - started_at
+            task_group.cancel_scope.cancel()
+
+    print_result(
+        'save',
+        settings.messages,
+        seconds,
+        memory_growth=get_peak_memory() - memory_before
+    )
+
+
+async def benchmark_register(settings):
+    server = FakeChatServer()
+    await server.start()
+    latencies = []
+    memory_before = get_peak_memory()
+
+    async def register(number):
+        started_at = time.perf_counter()
+        await registration.request_registration(
+            f'bot{number}', server.host, server.write_port)
+        latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(
+        register(number) for number in range(settings.registrations)
+    ))
+    seconds = time.perf_counter() - started_at
+
+    await server.stop()
+    print_result(
+        'register',
+        settings.registrations,
+        seconds,
+        latencies,
+        get_peak_memory() - memory_before
+    )
+
+
+async def benchmark_reconnect(settings):
+    logger = logging.getLogger('watchdog')
+    logger.setLevel(logging.ERROR)
+
+    server = FakeChatServer()
+    await server.start()
+
+    for name, recoveries in (
+            ('read', await measure_read_recovery(server, settings.rounds, logger)),
+            ('send', await measure_send_recovery(server, settings.rounds, False, logger)),
+            ('standby', await measure_send_recovery(server, settings.rounds, True, logger))):
+        recoveries = [recovery * 1000 for recovery in recoveries]
+        print(
+            f'reconnect {name:<8} p50 {statistics.median(recoveries):8.1f} ms'
+            f'   max {max(recoveries):8.1f} ms'
+        )
+
+    await server.stop()
+
+
+async def run_suite():
+    settings = get_settings()
+
+    await benchmark_read(settings)
+    await benchmark_send(settings)
+    await benchmark_save(settings)
+    await benchmark_register(settings)
+    await benchmark_reconnect(settings)
+
+
+if __name__ == '__main__':
+    run(run_suite)
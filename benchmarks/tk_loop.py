@@ -0,0 +1,128 @@
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import tkinter as tk
+from pathlib import Path
+from tkinter.scrolledtext import ScrolledText
+
+from anyio import create_task_group, run
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'graphical_app'))
+
+import gui  # noqa: E402
+import history  # noqa: E402
+
+
+def get_settings():
+    parser = argparse.ArgumentParser(
+        description='Idle CPU and render latency of the Tk update loop. '
+                    'Needs a display.',
+    )
+    parser.add_argument(
+        "-s",
+        "--seconds",
+        type=float,
+        default=5,
+        help="How long to measure each phase"
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=200,
+        help="Messages per second in the loaded phase"
+    )
+    return parser.parse_args()
+
+
+async def legacy_update_tk(root_frame, redraw_event, interval=1 / 120):
+    while True:
+        try:
+            root_frame.update()
+        except tk.TclError:
+            raise gui.TkAppClosed()
+        await asyncio.sleep(interval)
+
+
+async def measure_idle_cpu(seconds):
+    started_cpu = time.process_time()
+    await asyncio.sleep(seconds)
+    return (time.process_time() - started_cpu) / seconds * 100
+
+
+async def measure_latency(panel, messages_queue, seconds, rate):
+    latencies = []
+
+    def rendered(sent_at):
+        latencies.append(time.perf_counter() - sent_at)
+
+    finish_at = time.perf_counter() + seconds
+    while time.perf_counter() < finish_at:
+        sent_at = time.perf_counter()
+        messages_queue.put_nowait(history.ChatMessage.from_text(
+            f'Benchmark: message {len(latencies)}'))
+        # after_idle срабатывает, когда Tk действительно перерисовал окно
+        panel.after_idle(rendered, sent_at)
+        await asyncio.sleep(random.expovariate(rate))
+
+    await asyncio.sleep(0.1)
+    return latencies
+
+
+async def run_variant(update_tk, seconds, rate):
+    root = tk.Tk()
+    root_frame = tk.Frame()
+    root_frame.pack(fill="both", expand=True)
+    panel = ScrolledText(root_frame, wrap='none')
+    panel.pack(side="top", fill="both", expand=True)
+
+    messages_queue = asyncio.Queue()
+    redraw_event = asyncio.Event()
+    pager = history.HistoryPager('', 0)
+    result = {}
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(update_tk, root_frame, redraw_event)
+        task_group.start_soon(
+            gui.update_conversation_history,
+            panel,
+            messages_queue,
+            pager,
+            1000,
+            redraw_event
+        )
+        await asyncio.sleep(0.5)
+
+        result['idle_cpu'] = await measure_idle_cpu(seconds)
+        result['latencies'] = await measure_latency(
+            panel, messages_queue, seconds, rate)
+
+        task_group.cancel_scope.cancel()
+
+    root.destroy()
+    return result
+
+
+def print_result(name, result):
+    latencies = sorted(result['latencies'])
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(
+        f'{name:<10} idle CPU {result["idle_cpu"]:6.2f}%   '
+        f'render latency p50 {p50:6.2f} ms   p99 {p99:6.2f} ms'
+    )
+
+
+async def main():
+    settings = get_settings()
+
+    for name, update_tk in (('polling', legacy_update_tk), ('events', gui.update_tk)):
+        result = await run_variant(update_tk, settings.seconds, settings.rate)
+        print_result(name, result)
+
+
+if __name__ == '__main__':
+    run(main)
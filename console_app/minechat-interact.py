@@ -1,13 +1,21 @@
 import os
+import sys
+import time
 import argparse
 import json
 import asyncio
 import aiofiles
 import logging
-from contextlib import asynccontextmanager
+from pathlib import Path
 
 from dotenv import load_dotenv
 
+# общий с графическим приложением модуль протокола чата
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'graphical_app'))
+
+import network  # noqa: E402
+import protocol  # noqa: E402
+
 
 def get_settings():
     parser = argparse.ArgumentParser(
@@ -46,28 +54,45 @@ def get_settings():
         help="If you are not authorized, you can enter a login to register",
     )
 
-    return parser.parse_args()
-
-
-def escape_stickiness_removed(text):
-    return text.replace("\\n", " ").strip()
-
+    parser.add_argument(
+        "-b",
+        "--bulk",
+        type=str,
+        nargs="?",
+        const="-",
+        default=None,
+        help="Send every line of this file (or stdin if no file is given) "
+             "as a separate message over one connection",
+    )
 
-async def register(reader, writer):
-    data = await reader.read(100)
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=0,
+        help="Max messages per second in bulk mode. 0 means no limit",
+    )
 
-    writer.write("\n".encode())
+    parser.add_argument(
+        "--loop",
+        choices=network.EVENT_LOOPS,
+        default=os.getenv("EVENT_LOOP", "auto"),
+        help="Event loop: uvloop if it is installed (auto), "
+             "the standard asyncio loop or uvloop",
+    )
 
-    data = await reader.read(100)
-    logging.debug(msg=data.decode())
+    return parser.parse_args()
 
-    username = input() if not settings.name else settings.name
 
-    writer.write((escape_stickiness_removed(username) + "\n").encode())
+def ask_username(prompt):
+    logging.debug(msg=prompt)
+    return input() if not settings.name else settings.name
 
-    response = await reader.readline()
 
-    auth_data = json.loads(response.decode().strip())
+async def register(reader, writer):
+    handshake = protocol.Handshake(reader, writer)
+    auth_data = await handshake.register(ask_username)
+    logging.debug(msg=f"Зарегистрирован пользователь {auth_data['nickname']}")
 
     writer.close()
 
@@ -78,22 +103,27 @@ async def register(reader, writer):
 
 
 async def authorise(account_hash, reader, writer):
-    data = await reader.read(200)
-
-    writer.write((account_hash + "\n").encode())
+    handshake = protocol.Handshake(reader, writer)
+    account = await handshake.authorise(account_hash)
 
-    data = await reader.read(200)
+    if account is None:
+        logging.error(msg="Неверный токен, проверьте его или зарегистрируйтесь заново")
+        return
 
-    logging.debug(msg=data.decode().split("\n")[1], extra={"type": "sender"})
+    logging.debug(
+        msg=f"Выполнена авторизация. Пользователь {account['nickname']}",
+        extra={"type": "sender"}
+    )
 
-    await submit_message(reader, writer)
+    if settings.bulk:
+        await submit_messages_in_bulk(reader, writer)
+    else:
+        await submit_message(reader, writer)
 
 
 async def submit_message(reader, writer):
     try:
-        message = escape_stickiness_removed(input())
-
-        writer.write((message + "\n\n").encode())
+        writer.write(protocol.encode_message(input()))
 
         logging.debug("Закрытие соединения")
         writer.close()
@@ -102,14 +132,72 @@ async def submit_message(reader, writer):
         logging.error(msg="Ошибка сетевого подключения")
 
 
-@asynccontextmanager
-async def create_chat_connection(host, port):
-    reader, writer = await asyncio.open_connection(host, port)
+BULK_BATCH_SIZE = 500
+BULK_READ_SIZE = 64 * 1024
+
+
+def open_bulk_source(path):
+    if path == "-":
+        return sys.stdin
+    return open(path, 'r')
+
+
+async def count_acknowledgements(reader, counter):
+    while await reader.readline():
+        counter['acknowledged'] += 1
+
+
+async def wait_for_acknowledgements(counter, sent):
+    while counter['acknowledged'] < sent:
+        await asyncio.sleep(0.01)
+
+
+async def submit_messages_in_bulk(reader, writer):
+    counter = {'acknowledged': 0}
+    # сервер отвечает на каждое сообщение, ответы надо вычитывать,
+    # иначе он перестанет принимать новые сообщения
+    acknowledgements_task = asyncio.create_task(
+        count_acknowledgements(reader, counter))
+
+    sent = 0
+    started_at = time.monotonic()
+    # при ограничении скорости отправляем небольшими пачками, чтобы не рывками
+    batch_size = BULK_BATCH_SIZE
+    if settings.rate:
+        batch_size = min(BULK_BATCH_SIZE, max(1, int(settings.rate / 20)))
+
+    with open_bulk_source(settings.bulk) as source:
+        while lines := await asyncio.to_thread(source.readlines, BULK_READ_SIZE):
+            messages = [line for line in lines if line.strip()]
+
+            for start in range(0, len(messages), batch_size):
+                batch = messages[start:start + batch_size]
+
+                writer.writelines(
+                    [protocol.encode_message(message) for message in batch])
+                await writer.drain()
+                sent += len(batch)
+
+                if settings.rate:
+                    delay = started_at + sent / settings.rate - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
     try:
-        yield reader, writer
-    finally:
-        writer.close()
-        await writer.wait_closed()
+        await asyncio.wait_for(wait_for_acknowledgements(counter, sent), 5)
+    except asyncio.TimeoutError:
+        logging.warning("Сервер подтвердил не все сообщения")
+
+    acknowledgements_task.cancel()
+
+    elapsed = time.monotonic() - started_at
+    logging.info(
+        "Отправлено %d сообщений за %.2f с (%.0f сообщений/с)",
+        sent,
+        elapsed,
+        sent / elapsed if elapsed else sent,
+    )
+    writer.close()
 
 
 async def main():
@@ -117,7 +205,7 @@ async def main():
     port = settings.port
 
     if settings.token:
-        async with create_chat_connection(host, port) as (reader, writer):
+        async with protocol.create_chat_connection(host, port) as (reader, writer):
             await authorise(settings.token, reader, writer)
 
     elif os.path.exists(auth_file_name):
@@ -126,14 +214,14 @@ async def main():
 
         account_data = json.loads(account_data)
 
-        async with create_chat_connection(host, port) as (reader, writer):
+        async with protocol.create_chat_connection(host, port) as (reader, writer):
             await authorise(account_data["account_hash"], reader, writer)
 
     else:
-        async with create_chat_connection(host, port) as (reader, writer):
+        async with protocol.create_chat_connection(host, port) as (reader, writer):
             account_data = await register(reader, writer)
 
-        async with create_chat_connection(host, port) as (reader, writer):
+        async with protocol.create_chat_connection(host, port) as (reader, writer):
             await authorise(account_data["account_hash"], reader, writer)
 
 
@@ -146,4 +234,4 @@ if __name__ == "__main__":
         level=logging.DEBUG,
         format='%(levelname)s:sender:%(message)s',
     )
-    asyncio.run(main())
+    network.run_coroutine(main(), settings.loop)
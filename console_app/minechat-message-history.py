@@ -1,12 +1,22 @@
 import os
+import sys
+import time
+import random
 import argparse
 import asyncio
 import datetime
-from contextlib import asynccontextmanager
+from pathlib import Path
+from collections import deque
 
 import aiofiles
 from dotenv import load_dotenv
 
+# общий с графическим приложением модуль протокола чата
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'graphical_app'))
+
+import network  # noqa: E402
+import protocol  # noqa: E402
+
 
 def get_settings():
     load_dotenv()
@@ -35,44 +45,208 @@ def get_settings():
         default=os.getenv("HISTORY_PATH"),
         help="Path to history file. For example: messages.txt"
     )
+    parser.add_argument(
+        "-e",
+        "--endpoint",
+        type=parse_endpoint,
+        action="append",
+        default=[],
+        help="Server to archive as host:port or name=host:port, may be "
+             "repeated. For example: main=minechat.dvmn.org:5000. "
+             "Replaces --host and --port"
+    )
+    parser.add_argument(
+        "-m",
+        "--merge",
+        action="store_true",
+        help="Write messages from all servers to --history_path tagged with "
+             "the server name instead of one file per server"
+    )
+    parser.add_argument(
+        "--loop",
+        choices=network.EVENT_LOOPS,
+        default=os.getenv("EVENT_LOOP", "auto"),
+        help="Event loop: uvloop if it is installed (auto), "
+             "the standard asyncio loop or uvloop"
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Only save messages to the history file, do not print them"
+    )
 
     return parser.parse_args()
 
 
-async def get_chat_messages(settings):
-    async with create_chat_connection(settings.host, settings.port) as connection:
-        reader, writer = connection
+QUEUE_SIZE = 10000
+BATCH_SIZE = 1000
+REPLAY_WINDOW = 100
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+
+def parse_endpoint(text):
+    # host:port или name=host:port, имя попадает в имя файла и метку источника
+    name, separator, address = text.rpartition('=')
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f'Bad endpoint: {text}')
+
+    return name or f'{host}_{port}', host, int(port)
+
+
+def get_history_path(history_path, name, merge):
+    if merge:
+        return history_path
+
+    stem, extension = os.path.splitext(history_path)
+    return f'{stem}-{name}{extension}'
+
+
+async def drain_queue(queue):
+    items = [await queue.get()]
+    while len(items) < BATCH_SIZE and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
 
-        while not reader.at_eof():
-            try:
-                message = await reader.readline()
 
-                decode_message = f"""
-{datetime.datetime.now().strftime('[%d.%m.%y %H:%M]')} \
-{message.decode('utf-8').strip()}\n"""
+async def read_chat_messages(endpoint, raw_queue):
+    name, host, port = endpoint
+    delay = RECONNECT_DELAY
+    # после переподключения сервер заново присылает последние сообщения,
+    # их узнаём по хешам последних строк этого сервера
+    recent = deque(maxlen=REPLAY_WINDOW)
 
-                async with aiofiles.open(settings.history_path, 'a') as file:
-                    await file.write(decode_message)
+    while True:
+        replaying = False
+        try:
+            async with protocol.create_chat_connection(host, port) as connection:
+                reader, writer = connection
+                delay = RECONNECT_DELAY
+                replaying = bool(recent)
 
-                print(decode_message)
+                line_reader = protocol.LineReader(reader)
+                while messages := await line_reader.read_lines():
+                    received_at = time.time()
+                    for message in messages:
+                        message_hash = hash(message)
+                        if replaying and message_hash in recent:
+                            continue
 
-            except asyncio.CancelledError:
-                print("Ошибка сетевого подключения")
+                        replaying = False
+                        recent.append(message_hash)
+                        await raw_queue.put((received_at, name, message))
 
+        except OSError:
+            print(f"Ошибка сетевого подключения: {name}", file=sys.stderr)
 
-@asynccontextmanager
-async def create_chat_connection(host, port):
-    reader, writer = await asyncio.open_connection(host, port)
+        # серверы переподключаются независимо и не все разом
+        await asyncio.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+async def format_chat_messages(raw_queue, formatted_queue, tagged):
+    minute = None
+    timestamp = ''
+
+    while True:
+        batch = []
+        for received_at, name, message in await drain_queue(raw_queue):
+            # время в истории с точностью до минуты, strftime раз в минуту
+            if received_at // 60 != minute:
+                minute = received_at // 60
+                timestamp = datetime.datetime.fromtimestamp(
+                    received_at).strftime('[%d.%m.%y %H:%M]')
+
+            source = f' [{name}]' if tagged else ''
+            batch.append((
+                name,
+                f"\n{timestamp}{source} {message.decode('utf-8', 'replace').strip()}\n"
+            ))
+
+        await formatted_queue.put(batch)
+
+
+async def save_chat_messages(formatted_queue, history_paths, quiet):
+    # один открытый файл на файл истории, а не на сервер
+    files = {}
     try:
-        yield reader, writer
+        while True:
+            batches = await drain_queue(formatted_queue)
+            messages_by_path = {}
+            for batch in batches:
+                for name, message in batch:
+                    messages_by_path.setdefault(
+                        history_paths[name], []).append(message)
+
+            for history_path, messages in messages_by_path.items():
+                if history_path not in files:
+                    files[history_path] = await aiofiles.open(history_path, 'a')
+
+                await files[history_path].write(''.join(messages))
+                await files[history_path].flush()
+
+                if not quiet:
+                    sys.stdout.write(''.join(f'{message}\n' for message in messages))
+            sys.stdout.flush()
+
     finally:
-        writer.close()
-        await writer.wait_closed()
+        for file in files.values():
+            await file.close()
 
 
-async def main():
-    settings = get_settings()
+async def keep_running(name, coroutine_function, *args):
+    # все серверы делят форматирование и запись, поэтому ошибка в одной
+    # из задач не должна останавливать чтение с остальных серверов
+    while True:
+        try:
+            await coroutine_function(*args)
+        except Exception as error:
+            print(f"Ошибка {name}: {error!r}", file=sys.stderr)
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def get_chat_messages(settings):
+    endpoints = settings.endpoint or [
+        parse_endpoint(f'{settings.host}:{settings.port}')]
+    # один сервер без --merge пишет в --history_path, как и раньше
+    merge = settings.merge or len(endpoints) == 1
+    history_paths = {
+        name: get_history_path(settings.history_path, name, merge)
+        for name, _, _ in endpoints
+    }
+
+    raw_queue = asyncio.Queue(QUEUE_SIZE)
+    formatted_queue = asyncio.Queue(QUEUE_SIZE)
+
+    await asyncio.gather(
+        *(
+            keep_running(
+                f'чтения {endpoint[0]}', read_chat_messages, endpoint, raw_queue)
+            for endpoint in endpoints
+        ),
+        keep_running(
+            'форматирования',
+            format_chat_messages,
+            raw_queue,
+            formatted_queue,
+            merge and len(endpoints) > 1
+        ),
+        keep_running(
+            'записи',
+            save_chat_messages,
+            formatted_queue,
+            history_paths,
+            settings.quiet
+        ),
+    )
+
+
+async def main(settings):
     await get_chat_messages(settings)
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    settings = get_settings()
+    network.run_coroutine(main(settings), settings.loop)
@@ -0,0 +1,46 @@
+import time
+from enum import Enum
+
+
+# события, которыми сеть сообщает окну о своём состоянии; модуль не
+# импортирует tkinter, и сетевой код работает без окна, например в релее
+
+
+class ReadConnectionStateChanged(Enum):
+    INITIATED = 'устанавливаем соединение'
+    ESTABLISHED = 'соединение установлено'
+    CLOSED = 'соединение закрыто'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class SendingConnectionStateChanged(Enum):
+    INITIATED = 'устанавливаем соединение'
+    ESTABLISHED = 'соединение установлено'
+    CLOSED = 'соединение закрыто'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class NicknameReceived:
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class SendingStatsChanged:
+    def __init__(self, backlog, latency):
+        self.backlog = backlog
+        self.latency = latency
+
+
+class OutgoingMessage:
+    def __init__(self, text, seq=None):
+        self.text = text
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+
+class TokenRejected:
+    pass
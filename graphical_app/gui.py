@@ -1,86 +1,320 @@
+import time
 import asyncio
+import _tkinter
+import functools
 import tkinter as tk
-from enum import Enum
+from tkinter import messagebox
 from tkinter.scrolledtext import ScrolledText
 
 from anyio import create_task_group
+from async_timeout import timeout
+
+import queues
+import metrics
+from events import (
+    ReadConnectionStateChanged,
+    SendingConnectionStateChanged,
+    NicknameReceived,
+    SendingStatsChanged,
+    TokenRejected,
+)
+from outbox import enqueue_message
 
 
 class TkAppClosed(Exception):
     pass
 
 
-class ReadConnectionStateChanged(Enum):
-    INITIATED = 'устанавливаем соединение'
-    ESTABLISHED = 'соединение установлено'
-    CLOSED = 'соединение закрыто'
-
-    def __str__(self):
-        return str(self.value)
-
+def process_new_message(input_field, submit_text):
+    if not submit_text(input_field.get()):
+        # очередь отправки забита, оставляем текст в поле ввода
+        input_field.bell()
+        return
 
-class SendingConnectionStateChanged(Enum):
-    INITIATED = 'устанавливаем соединение'
-    ESTABLISHED = 'соединение установлено'
-    CLOSED = 'соединение закрыто'
+    input_field.delete(0, tk.END)
 
-    def __str__(self):
-        return str(self.value)
 
+FRAME_INTERVAL = 1 / 120
+IDLE_INTERVAL = 1 / 20
+STATUS_UPDATES_PER_FRAME = 100
+MAX_MESSAGES_PER_FRAME = 500
+SEARCH_LIMIT = 1000
 
-class NicknameReceived:
-    def __init__(self, nickname):
-        self.nickname = nickname
 
+def process_tk_events(root_frame):
+    # update() не говорит, были ли события, а dooneevent возвращает 0,
+    # когда обрабатывать больше нечего
+    root_frame.winfo_exists()
+    processed = 0
+    while root_frame.tk.dooneevent(_tkinter.DONT_WAIT):
+        processed += 1
+    return processed
 
-def process_new_message(input_field, sending_queue):
-    text = input_field.get()
-    sending_queue.put_nowait(text)
-    input_field.delete(0, tk.END)
 
+async def update_tk(
+        root_frame,
+        redraw_event,
+        min_interval=FRAME_INTERVAL,
+        max_interval=IDLE_INTERVAL):
 
-async def update_tk(root_frame, interval=1 / 120):
+    interval = min_interval
     while True:
         try:
-            root_frame.update()
+            has_events = process_tk_events(root_frame)
         except tk.TclError:
             # if application has been destroyed/closed
             raise TkAppClosed()
-        await asyncio.sleep(interval)
 
+        # пока пользователь ничего не делает, просыпаемся всё реже,
+        # а новые сообщения будят цикл сразу через redraw_event
+        if has_events:
+            interval = min_interval
+        else:
+            interval = min(interval * 2, max_interval)
 
-async def update_conversation_history(panel, messages_queue):
-    while True:
-        msg = await messages_queue.get()
+        redraw_event.clear()
+        try:
+            async with timeout(interval):
+                await redraw_event.wait()
+        except asyncio.TimeoutError:
+            pass
+
+
+def is_scrolled_to_bottom(panel):
+    return panel.yview()[1] == 1.0
+
+
+def count_lines(panel):
+    return int(panel.index('end-1c').split('.')[0])
+
+
+def trim_head(panel, history_pager, max_lines):
+    excess = count_lines(panel) - max_lines
+    if excess <= 0:
+        return
+
+    # строка, которая была вверху окна, там и остаётся
+    top_line = int(panel.index('@0,0').split('.')[0])
+    panel.delete('1.0', f'{excess + 1}.0')
+    history_pager.trim_top(excess)
+    panel.yview(f'{max(top_line - excess, 1)}.0')
+
+
+def trim_tail(panel, history_pager, max_lines):
+    excess = count_lines(panel) - max_lines
+    if excess <= 0:
+        return
+
+    # вместе с переводом строки перед первой убранной строкой
+    panel.delete(f'{max_lines}.end', 'end-1c')
+    history_pager.trim_bottom(excess)
+
+
+def render_messages(panel, messages, history_pager, max_lines, dequeued_at):
+    # пока в окне открыт архив, новые сообщения подгрузятся
+    # из файла истории, когда пользователь долистает до конца
+    if not history_pager.is_live():
+        return
+
+    # пустые строки не попадают в окно, как и при чтении файла истории
+    shown = [message for message in messages if message.text]
+    if shown:
+        # не мешаем читать историю: прокручиваем вниз, только если
+        # пользователь и так был внизу
+        scrolled_to_bottom = is_scrolled_to_bottom(panel)
 
         panel['state'] = 'normal'
+        text = '\n'.join(message.text for message in shown)
         if panel.index('end-1c') != '1.0':
-            panel.insert('end', '\n')
-        panel.insert('end', msg)
-        # TODO сделать промотку умной, чтобы не мешала просматривать историю сообщений
-        # ScrolledText.frame
-        # ScrolledText.vbar
-        panel.yview(tk.END)
+            text = '\n' + text
+        panel.insert('end', text)
+        history_pager.add_messages(shown)
+
+        # окно не растёт, даже когда его прокрутили вверх и оставили
+        trim_head(panel, history_pager, max_lines)
+        if scrolled_to_bottom:
+            panel.yview(tk.END)
         panel['state'] = 'disabled'
 
+    metrics.observe_batch(messages, 'gui_queue', 'gui_render', dequeued_at)
+
+
+async def update_conversation_history(
+        panel,
+        messages_queue,
+        history_pager,
+        max_lines,
+        redraw_event,
+        max_per_frame=MAX_MESSAGES_PER_FRAME):
+
+    while True:
+        msg = await messages_queue.get()
+        messages = queues.drain_queue(messages_queue, msg, max_per_frame)
+        render_messages(
+            panel, messages, history_pager, max_lines, time.perf_counter())
+        redraw_event.set()
+
+        # остаток очереди дорисуем в следующем кадре, чтобы окно не зависало
+        await asyncio.sleep(FRAME_INTERVAL)
+
+
+def load_previous_history(panel, history_pager, max_lines):
+    history_pager.loading = False
+    lines = history_pager.load_previous()
+    if not lines:
+        return
+
+    panel['state'] = 'normal'
+    if panel.index('end-1c') != '1.0':
+        panel.insert('1.0', '\n'.join(lines) + '\n')
+    else:
+        panel.insert('1.0', '\n'.join(lines))
+    trim_tail(panel, history_pager, max_lines)
+    panel['state'] = 'disabled'
+    # оставляем на экране ту строку, которая была сверху до подгрузки
+    panel.yview(f'{len(lines) + 1}.0')
+
+
+def load_next_history(panel, history_pager, max_lines):
+    history_pager.loading = False
+    lines = history_pager.load_next()
+    if not lines:
+        return
+
+    panel['state'] = 'normal'
+    panel.insert('end', '\n' + '\n'.join(lines))
+    trim_head(panel, history_pager, max_lines)
+    panel['state'] = 'disabled'
+
+
+def watch_history_scroll(panel, history_pager, max_lines):
+    def on_scroll(first, last):
+        panel.vbar.set(first, last)
+        if history_pager.loading:
+            return
+
+        if float(first) == 0 and history_pager.has_previous():
+            history_pager.loading = True
+            panel.after_idle(
+                load_previous_history, panel, history_pager, max_lines)
+
+        elif float(last) == 1 and not history_pager.is_live():
+            history_pager.loading = True
+            panel.after_idle(
+                load_next_history, panel, history_pager, max_lines)
+
+    panel['yscrollcommand'] = on_scroll
+
+
+def show_search_result(panel, history_pager, offset):
+    lines, hit_index = history_pager.jump(offset)
+
+    panel['state'] = 'normal'
+    panel.delete('1.0', tk.END)
+    panel.insert('1.0', '\n'.join(lines))
+    panel.tag_remove('search_hit', '1.0', tk.END)
+    panel.tag_add('search_hit', f'{hit_index + 1}.0', f'{hit_index + 1}.end')
+    panel['state'] = 'disabled'
+
+    panel.see(f'{hit_index + 1}.0')
+
+
+def search_history(
+        search_field,
+        search_label,
+        panel,
+        history_pager,
+        history_index,
+        search_state):
+
+    query = search_field.get().strip()
+    if not query:
+        return
 
-async def update_status_panel(status_labels, status_updates_queue):
-    nickname_label, read_label, write_label = status_labels
+    # повторный Enter с тем же запросом переходит к следующему, более старому
+    if query == search_state.get('query'):
+        search_state['position'] += 1
+    else:
+        search_state['query'] = query
+        search_state['position'] = 0
+        # GUI нужны только смещения, сами строки прочитает history_pager
+        search_state['results'] = history_index.search_offsets(query, SEARCH_LIMIT)
+
+    results = search_state['results']
+    if not results:
+        search_label['text'] = 'Ничего не найдено'
+        return
+
+    search_state['position'] %= len(results)
+    offset = results[search_state['position']]
+    show_search_result(panel, history_pager, offset)
+
+    search_label['text'] = f'{search_state["position"] + 1} из {len(results)}'
+
+
+def create_search_panel(root_frame):
+    search_frame = tk.Frame(root_frame)
+    search_frame.pack(side="top", fill=tk.X)
+
+    search_field = tk.Entry(search_frame)
+    search_field.pack(side="left", fill=tk.X, expand=True)
+
+    search_button = tk.Button(search_frame)
+    search_button["text"] = "Найти"
+    search_button.pack(side="left")
+
+    search_label = tk.Label(search_frame, fg='grey', font='arial 10')
+    search_label.pack(side="left")
+
+    return search_field, search_button, search_label
+
+
+def reset_status_panel(status_labels):
+    nickname_label, read_label, write_label, sending_stats_label = status_labels
 
     read_label['text'] = f'Чтение: нет соединения'
     write_label['text'] = f'Отправка: нет соединения'
     nickname_label['text'] = f'Имя пользователя: неизвестно'
+    sending_stats_label['text'] = f'Очередь отправки: 0'
 
-    while True:
-        msg = await status_updates_queue.get()
-        if isinstance(msg, ReadConnectionStateChanged):
-            read_label['text'] = f'Чтение: {msg}'
 
-        if isinstance(msg, SendingConnectionStateChanged):
-            write_label['text'] = f'Отправка: {msg}'
+def show_status(status_labels, msg):
+    nickname_label, read_label, write_label, sending_stats_label = status_labels
+
+    if isinstance(msg, ReadConnectionStateChanged):
+        read_label['text'] = f'Чтение: {msg}'
+
+    if isinstance(msg, SendingConnectionStateChanged):
+        write_label['text'] = f'Отправка: {msg}'
+
+    if isinstance(msg, NicknameReceived):
+        nickname_label['text'] = f'Имя пользователя: {msg.nickname}'
 
-        if isinstance(msg, NicknameReceived):
-            nickname_label['text'] = f'Имя пользователя: {msg.nickname}'
+    if isinstance(msg, SendingStatsChanged):
+        sending_stats_label['text'] = (
+            f'Очередь отправки: {msg.backlog}, '
+            f'задержка: {msg.latency * 1000:.0f} мс'
+        )
+
+    if isinstance(msg, TokenRejected):
+        messagebox.showerror(
+            "Неверный токен",
+            "Проверьте токен, сервер его не узнал."
+        )
+        raise TkAppClosed()
+
+
+async def update_status_panel(
+        status_labels,
+        status_updates_queue,
+        redraw_event):
+
+    reset_status_panel(status_labels)
+
+    while True:
+        msg = await status_updates_queue.get()
+        show_status(status_labels, msg)
+        redraw_event.set()
 
 
 def create_status_panel(root_frame):
@@ -102,10 +336,19 @@ def create_status_panel(root_frame):
         connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
     status_write_label.pack(side="top", fill=tk.X)
 
-    return (nickname_label, status_read_label, status_write_label)
+    sending_stats_label = tk.Label(
+        connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
+    sending_stats_label.pack(side="top", fill=tk.X)
+
+    return (
+        nickname_label,
+        status_read_label,
+        status_write_label,
+        sending_stats_label
+    )
 
 
-async def draw(messages_queue, sending_queue, status_updates_queue):
+def create_window(submit_text, history_pager, max_lines, history_index):
     root = tk.Tk()
 
     root.title('Чат Майнкрафтера')
@@ -123,23 +366,153 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
 
     input_field.bind("<Return>", lambda event: process_new_message(
         input_field,
-        sending_queue
+        submit_text
     ))
 
     send_button = tk.Button(input_frame)
     send_button["text"] = "Отправить"
     send_button["command"] = lambda: process_new_message(
         input_field,
-        sending_queue
+        submit_text
     )
     send_button.pack(side="left")
 
+    search_field, search_button, search_label = create_search_panel(root_frame)
+
     conversation_panel = ScrolledText(root_frame, wrap='none')
     conversation_panel.pack(side="top", fill="both", expand=True)
+    conversation_panel.tag_config('search_hit', background='yellow')
+    watch_history_scroll(conversation_panel, history_pager, max_lines)
+
+    search_state = {}
+
+    def on_search(event=None):
+        search_history(
+            search_field,
+            search_label,
+            conversation_panel,
+            history_pager,
+            history_index,
+            search_state
+        )
+
+    search_field.bind("<Return>", on_search)
+    search_button["command"] = on_search
+
+    return root, root_frame, conversation_panel, status_labels
+
+
+async def draw(
+        messages_queue,
+        sending_queue,
+        status_updates_queue,
+        history_pager,
+        max_lines,
+        outbox,
+        history_index):
+
+    submit_text = functools.partial(enqueue_message, sending_queue, outbox)
+    root, root_frame, conversation_panel, status_labels = create_window(
+        submit_text, history_pager, max_lines, history_index)
+
+    redraw_event = asyncio.Event()
 
     async with create_task_group() as task_group:
-        task_group.start_soon(update_tk, root_frame)
+        task_group.start_soon(update_tk, root_frame, redraw_event)
         task_group.start_soon(
-            update_conversation_history, conversation_panel, messages_queue)
+            update_conversation_history,
+            conversation_panel,
+            messages_queue,
+            history_pager,
+            max_lines,
+            redraw_event
+        )
         task_group.start_soon(
-            update_status_panel, status_labels, status_updates_queue)
+            update_status_panel,
+            status_labels,
+            status_updates_queue,
+            redraw_event
+        )
+
+
+def poll_updates(
+        root,
+        conversation_panel,
+        status_labels,
+        messages_ring,
+        status_ring,
+        history_pager,
+        max_lines,
+        is_network_alive,
+        interval):
+
+    try:
+        if not is_network_alive():
+            raise TkAppClosed()
+
+        for msg in status_ring.drain(STATUS_UPDATES_PER_FRAME):
+            show_status(status_labels, msg)
+
+        messages = messages_ring.drain(MAX_MESSAGES_PER_FRAME)
+        if messages:
+            render_messages(
+                conversation_panel,
+                messages,
+                history_pager,
+                max_lines,
+                time.perf_counter()
+            )
+
+    except TkAppClosed:
+        root.destroy()
+        return
+
+    # как и update_tk: пока сообщений нет, опрашиваем всё реже
+    if messages:
+        interval = FRAME_INTERVAL
+    else:
+        interval = min(interval * 2, IDLE_INTERVAL)
+
+    root.after(
+        int(interval * 1000) or 1,
+        poll_updates,
+        root,
+        conversation_panel,
+        status_labels,
+        messages_ring,
+        status_ring,
+        history_pager,
+        max_lines,
+        is_network_alive,
+        interval
+    )
+
+
+def draw_threaded(
+        messages_ring,
+        status_ring,
+        submit_text,
+        history_pager,
+        max_lines,
+        history_index,
+        is_network_alive):
+
+    # Окно живёт в главном потоке со своим mainloop, а сеть - в отдельном
+    # потоке со своим циклом событий. Сообщения и статусы приходят через
+    # кольцевые буферы, которые окно само забирает по таймеру after()
+    root, _, conversation_panel, status_labels = create_window(
+        submit_text, history_pager, max_lines, history_index)
+    reset_status_panel(status_labels)
+
+    poll_updates(
+        root,
+        conversation_panel,
+        status_labels,
+        messages_ring,
+        status_ring,
+        history_pager,
+        max_lines,
+        is_network_alive,
+        FRAME_INTERVAL
+    )
+    root.mainloop()
@@ -0,0 +1,362 @@
+import os
+import mmap
+import time
+from collections import deque
+
+
+# столько последних сообщений сервер присылает после каждого подключения
+SERVER_BACKLOG = 100
+# повтор истории сервер присылает одной пачкой сразу после подключения
+REPLAY_BURST_GAP = 0.1
+REPLAY_TIMEOUT = 1
+
+
+def escape_stickiness_removed(text):
+    return text.replace("\\n", " ").strip()
+
+
+def split_author(text):
+    author, separator, body = text.partition(': ')
+    if not separator:
+        return '', text
+    return author, body
+
+
+def split_lines(data):
+    # bytes.splitlines() режет ещё и по \r, а сообщения в чате и в файле
+    # истории разделяет только \n
+    if b'\r' not in data:
+        return data.splitlines(keepends=True)
+
+    lines = data.split(b'\n')
+    tail = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if tail:
+        lines.append(tail)
+    return lines
+
+
+class ChatMessage:
+    # Одна запись на строку от сервера, её по ссылке получают окно чата,
+    # история и фильтр повторов. Текст декодируется один раз и только
+    # когда он кому-то понадобился
+    __slots__ = ('received_at', 'raw', 'trace', 'offset', '_text', '_parts')
+
+    def __init__(self, raw, received_at=None):
+        self.raw = raw
+        self.received_at = time.time() if received_at is None else received_at
+        # perf_counter() после readline, если сообщение попало в выборку
+        self.trace = None
+        # смещение строки в файле истории, известно после записи в файл
+        self.offset = None
+        self._text = None
+        self._parts = None
+
+    @classmethod
+    def from_text(cls, text, received_at=None):
+        message = cls((text + '\n').encode('utf-8'), received_at)
+        message._text = text
+        return message
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = escape_stickiness_removed(
+                self.raw.decode('utf-8', 'replace'))
+        return self._text
+
+    @property
+    def author(self):
+        if self._parts is None:
+            self._parts = split_author(self.text)
+        return self._parts[0]
+
+    @property
+    def body(self):
+        if self._parts is None:
+            self._parts = split_author(self.text)
+        return self._parts[1]
+
+
+def read_entries_before(history_path, offset, count):
+    # Сканируем файл с конца, поэтому время чтения не зависит от его размера.
+    # Возвращает пары (смещение строки, строка) и смещение первой из них
+    if not os.path.exists(history_path):
+        return [], 0
+
+    with open(history_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return [], 0
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as history_map:
+            end = size if offset is None else min(offset, size)
+            entries = []
+
+            while end > 0 and len(entries) < count:
+                start = history_map.rfind(b'\n', 0, end - 1) + 1
+                line = history_map[start:end].decode('utf-8', 'replace')
+                line = escape_stickiness_removed(line)
+                if line:
+                    entries.append((start, line))
+                end = start
+
+    entries.reverse()
+    return entries, end
+
+
+def read_lines_before(history_path, offset, count):
+    entries, end = read_entries_before(history_path, offset, count)
+    return [line for _, line in entries], end
+
+
+def read_entries_after(history_path, offset, count):
+    if not os.path.exists(history_path):
+        return [], offset
+
+    with open(history_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if offset >= size:
+            return [], size
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as history_map:
+            entries = []
+            while offset < size and len(entries) < count:
+                end = history_map.find(b'\n', offset)
+                end = size if end == -1 else end + 1
+                line = history_map[offset:end].decode('utf-8', 'replace')
+                line = escape_stickiness_removed(line)
+                if line:
+                    entries.append((offset, line))
+                offset = end
+
+    return entries, offset
+
+
+def read_lines_after(history_path, offset, count):
+    entries, offset = read_entries_after(history_path, offset, count)
+    return [line for _, line in entries], offset
+
+
+def read_line_at(history_path, offset):
+    lines, _ = read_lines_after(history_path, offset, 1)
+    return lines[0] if lines else ''
+
+
+def skip_lines_after(history_path, offset, count):
+    if not os.path.exists(history_path):
+        return offset
+
+    with open(history_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if offset >= size:
+            return offset
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as history_map:
+            while offset < size and count > 0:
+                end = history_map.find(b'\n', offset)
+                end = size if end == -1 else end + 1
+                line = history_map[offset:end].decode('utf-8', 'replace')
+                if escape_stickiness_removed(line):
+                    count -= 1
+                offset = end
+
+    return offset
+
+
+def get_row_offset(row):
+    # строка окна чата - это смещение строки из файла истории или
+    # сообщение от сервера, смещение которого известно после записи
+    if isinstance(row, int):
+        return row
+    return row.offset
+
+
+class HistoryPager:
+    def __init__(self, history_path, page_size):
+        self.history_path = history_path
+        self.page_size = page_size
+        self.top_offset = None
+        # None значит, что внизу окна чата живые сообщения, а не архив
+        self.bottom_offset = None
+        self.loading = False
+        # по записи на каждую строку окна чата, по ним считаются
+        # смещения краёв окна, когда строки из него убираются
+        self.rows = deque()
+
+    def has_previous(self):
+        return self.top_offset is None or self.top_offset > 0
+
+    def read_tail(self):
+        entries, self.top_offset = read_entries_before(
+            self.history_path, None, self.page_size)
+        return entries
+
+    def load_previous(self):
+        entries, self.top_offset = read_entries_before(
+            self.history_path, self.top_offset, self.page_size)
+        self.rows.extendleft(offset for offset, _ in reversed(entries))
+        return [line for _, line in entries]
+
+    def is_live(self):
+        return self.bottom_offset is None
+
+    def jump(self, offset):
+        entries_before, self.top_offset = read_entries_before(
+            self.history_path, offset, self.page_size // 2)
+        entries_after, self.bottom_offset = self.read_next(offset)
+
+        entries = entries_before + entries_after
+        self.rows = deque(offset for offset, _ in entries)
+        return [line for _, line in entries], len(entries_before)
+
+    def read_next(self, offset):
+        entries, bottom_offset = read_entries_after(
+            self.history_path, offset, self.page_size)
+        if bottom_offset >= os.path.getsize(self.history_path):
+            bottom_offset = None
+        return entries, bottom_offset
+
+    def load_next(self):
+        if self.is_live():
+            return []
+
+        entries, self.bottom_offset = self.read_next(self.bottom_offset)
+        self.rows.extend(offset for offset, _ in entries)
+        return [line for _, line in entries]
+
+    def add_messages(self, messages):
+        self.rows.extend(messages)
+
+    def get_row_end(self, row):
+        # строки из хвоста истории при запуске создаются заново из текста,
+        # поэтому длину строки берём из файла, а не из message.raw
+        return skip_lines_after(self.history_path, get_row_offset(row), 1)
+
+    def trim_top(self, count):
+        # строки убраны из начала окна чата, их можно будет подгрузить снова
+        removed = [self.rows.popleft() for _ in range(min(count, len(self.rows)))]
+
+        if self.rows and get_row_offset(self.rows[0]) is not None:
+            self.top_offset = get_row_offset(self.rows[0])
+            return
+
+        # сообщение сверху ещё не записано в файл: окно начинается сразу
+        # за последней убранной строкой, смещение которой известно
+        for row in reversed(removed):
+            if get_row_offset(row) is not None:
+                self.top_offset = self.get_row_end(row)
+                return
+
+    def trim_bottom(self, count):
+        # строки убраны из конца окна чата, дальше окно показывает архив,
+        # а живые сообщения подгрузятся из файла, когда до них долистают
+        removed = [self.rows.pop() for _ in range(min(count, len(self.rows)))]
+        if not removed:
+            return
+
+        first_removed = removed[-1]
+        if get_row_offset(first_removed) is not None:
+            self.bottom_offset = get_row_offset(first_removed)
+        elif self.rows and get_row_offset(self.rows[-1]) is not None:
+            self.bottom_offset = self.get_row_end(self.rows[-1])
+        else:
+            # сообщения ещё не записаны, в файле они окажутся после его конца
+            self.bottom_offset = os.path.getsize(self.history_path)
+
+
+class ReplayFilter:
+    def __init__(
+            self,
+            window_size,
+            server_backlog=SERVER_BACKLOG,
+            burst_gap=REPLAY_BURST_GAP,
+            replay_timeout=REPLAY_TIMEOUT):
+        self.window_size = window_size
+        self.server_backlog = server_backlog
+        self.burst_gap = burst_gap
+        self.replay_timeout = replay_timeout
+        self.first_read_at = None
+        self.last_read_at = None
+        self.window = deque()
+        self.counts = {}
+        self.replaying = False
+        self.replay_left = 0
+        self.seen_in_replay = False
+        # новые строки повтора запоминаем только после его конца, чтобы
+        # одинаковые сообщения внутри повтора не считались повторами
+        self.replayed = []
+
+    def seed(self, history_path):
+        lines, _ = read_lines_before(history_path, None, self.window_size)
+        for line in lines:
+            self.remember(hash(line))
+
+    def remember(self, line_hash):
+        self.window.append(line_hash)
+        self.counts[line_hash] = self.counts.get(line_hash, 0) + 1
+
+        if len(self.window) > self.window_size:
+            old_hash = self.window.popleft()
+            self.counts[old_hash] -= 1
+            if not self.counts[old_hash]:
+                del self.counts[old_hash]
+
+    def start_replay(self):
+        # с пустым окном сравнивать не с чем, всё, что пришло, - новое.
+        # Сервер повторяет не больше server_backlog сообщений, дальше
+        # идут только живые, даже если совпадений так и не нашлось
+        self.replaying = bool(self.window_size and self.window)
+        self.replay_left = self.server_backlog
+        self.seen_in_replay = False
+        self.first_read_at = None
+        self.last_read_at = None
+
+    def on_read(self, now=None):
+        # повтор приходит первой пачкой чтений: пауза между чтениями или
+        # слишком долгая пачка значат, что дальше идут живые сообщения,
+        # даже если повтор оказался короче server_backlog
+        if not self.replaying:
+            return
+
+        now = time.monotonic() if now is None else now
+        if self.first_read_at is None:
+            self.first_read_at = now
+        elif now - self.last_read_at > self.burst_gap \
+                or now - self.first_read_at > self.replay_timeout:
+            self.stop_replay()
+        self.last_read_at = now
+
+    def stop_replay(self):
+        self.replaying = False
+        for line_hash in self.replayed:
+            self.remember(line_hash)
+        self.replayed = []
+
+    def is_duplicate(self, line):
+        if not self.window_size:
+            return False
+
+        line_hash = hash(line)
+        if self.replaying:
+            if line_hash in self.counts:
+                self.seen_in_replay = True
+                self.count_replayed()
+                return True
+
+            # после уже виденных строк пошли новые, значит повтор
+            # истории закончился и дальше идут живые сообщения
+            if not self.seen_in_replay:
+                self.replayed.append(line_hash)
+                self.count_replayed()
+                return False
+
+            self.stop_replay()
+
+        self.remember(line_hash)
+        return False
+
+    def count_replayed(self):
+        self.replay_left -= 1
+        if self.replay_left <= 0:
+            self.stop_replay()
@@ -1,20 +1,42 @@
 import os
 import json
+import time
 import logging
+import queue
 import asyncio
 import argparse
-from tkinter import messagebox
-from contextlib import asynccontextmanager
-
-import aiofiles
+import threading
+import functools
+from collections import deque
 from dotenv import load_dotenv
 from async_timeout import timeout
 from anyio import create_task_group, run
 
-import gui
+import events
+import queues
+import reading
+import outbox
+import metrics
+import protocol
+import history
+import network
 import registration
 
 
+SEND_BATCH_SIZE = 100
+STATUS_RING_SIZE = 100
+NETWORK_THREAD_JOIN_TIMEOUT = 5
+WRITE_BUFFER_HIGH = 64 * 1024
+WRITE_BUFFER_LOW = 16 * 1024
+
+QUEUE_DEFAULTS = {
+    'messages': (10000, 'drop_oldest'),
+    'history': (10000, 'block'),
+    'sending': (1000, 'block'),
+    'status': (10, 'coalesce'),
+}
+
+
 class UnixTimeFormatter(logging.Formatter):
     def formatTime(self, record, datefmt=None):
         return f"[{int(record.created)}]"
@@ -80,186 +102,578 @@ def get_settings():
         help="Path to history file. For example: messages.txt"
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "-ht",
+        "--history_tail",
+        type=int,
+        default=os.getenv("HISTORY_TAIL", 100),
+        help="How many last messages to show at startup and per history page"
+    )
 
+    parser.add_argument(
+        "-ml",
+        "--max_lines",
+        type=int,
+        default=os.getenv("MAX_LINES", 5000),
+        help="How many lines to keep in the chat window"
+    )
 
-def escape_stickiness_removed(text):
-    return text.replace("\\n", " ").strip()
+    parser.add_argument(
+        "--history_batch_size",
+        type=int,
+        default=os.getenv("HISTORY_BATCH_SIZE", 500),
+        help="Max messages written to the history file in one call"
+    )
 
+    parser.add_argument(
+        "--history_batch_bytes",
+        type=int,
+        default=os.getenv("HISTORY_BATCH_BYTES", 64 * 1024),
+        help="Max size of one history batch in bytes"
+    )
 
-async def watch_for_connection(watchdog_queue, watchdog_logger):
-    while True:
-        try:
-            async with timeout(10):
-                msg = await watchdog_queue.get()
-                watchdog_logger.info('Connection is alive. %s', msg)
+    parser.add_argument(
+        "--history_flush_interval",
+        type=float,
+        default=os.getenv("HISTORY_FLUSH_INTERVAL", 0.2),
+        help="How long to wait for more messages before writing a batch"
+    )
 
-        except asyncio.TimeoutError:
-            watchdog_logger.warning('Reconnecting...')
-            raise ConnectionError
+    parser.add_argument(
+        "--history_fsync",
+        choices=["none", "batch", "interval"],
+        default=os.getenv("HISTORY_FSYNC", "none"),
+        help="When to fsync the history file: never, after every batch "
+             "or every --history_fsync_interval seconds"
+    )
 
+    parser.add_argument(
+        "--history_fsync_interval",
+        type=float,
+        default=os.getenv("HISTORY_FSYNC_INTERVAL", 5),
+        help="Seconds between fsyncs for --history_fsync interval"
+    )
 
-@asynccontextmanager
-async def create_chat_connection(host, port):
-    reader, writer = await asyncio.open_connection(host, port)
-    try:
-        yield reader, writer
-    finally:
-        writer.close()
-        await writer.wait_closed()
+    parser.add_argument(
+        "--history_store",
+        choices=["none", "sqlite"],
+        default=os.getenv("HISTORY_STORE", "none"),
+        help="Also keep the history in a SQLite archive next to the text file"
+    )
 
+    parser.add_argument(
+        "--history_db",
+        type=str,
+        default=os.getenv("HISTORY_DB"),
+        help="Path to the SQLite archive. By default HISTORY_PATH.db"
+    )
 
-async def save_messages(history_message_queue, history_path):
-    async with aiofiles.open(history_path, 'a') as file:
-        while True:
-            msg = await history_message_queue.get()
-            await file.write(msg)
+    parser.add_argument(
+        "--dedup_window",
+        type=int,
+        default=os.getenv("DEDUP_WINDOW", 1000),
+        help="How many last messages to remember to skip the history "
+             "the server repeats after every reconnect. 0 disables"
+    )
 
+    parser.add_argument(
+        "--server_backlog",
+        type=int,
+        default=os.getenv("SERVER_BACKLOG", history.SERVER_BACKLOG),
+        help="How many last messages the server repeats after every "
+             "reconnect. Later messages are never skipped as repeats"
+    )
 
-async def read_messages(
-        messages_queue,
+    parser.add_argument(
+        "--outbox_path",
+        type=str,
+        default=os.getenv("OUTBOX_PATH", "outbox.jsonl"),
+        help="Journal of messages that are not sent yet"
+    )
+
+    parser.add_argument(
+        "--outbox_fsync_interval",
+        type=float,
+        default=os.getenv("OUTBOX_FSYNC_INTERVAL", 1),
+        help="Seconds between fsyncs of the outbox journal"
+    )
+
+    parser.add_argument(
+        "-wt",
+        "--watchdog_timeout",
+        type=float,
+        default=os.getenv("WATCHDOG_TIMEOUT", 10),
+        help="Reconnect after this many seconds without server activity"
+    )
+
+    parser.add_argument(
+        "--ping_interval",
+        type=float,
+        default=os.getenv("PING_INTERVAL", 0),
+        help="Send an empty message to the server after this many seconds "
+             "of silence to check the connection. 0 disables pings"
+    )
+
+    parser.add_argument(
+        "--keepalive_idle",
+        type=int,
+        default=os.getenv("KEEPALIVE_IDLE", 10),
+        help="Seconds before TCP keepalive probes start. 0 disables keepalive"
+    )
+
+    parser.add_argument(
+        "--standby",
+        action="store_true",
+        help="Keep a second authorised connection for sending messages "
+             "to switch to it instantly when the first one is lost"
+    )
+
+    parser.add_argument(
+        "--trace_sample",
+        type=int,
+        default=os.getenv("TRACE_SAMPLE", 0),
+        help="Measure how long every Nth message spends in each stage "
+             "of the client. 0 disables tracing"
+    )
+
+    parser.add_argument(
+        "--metrics_host",
+        type=str,
+        default=os.getenv("METRICS_HOST", "127.0.0.1"),
+        help="Address of the metrics endpoint"
+    )
+
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=os.getenv("METRICS_PORT", 0),
+        help="Serve metrics in Prometheus text format on this port. "
+             "0 disables the endpoint"
+    )
+
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=os.getenv("METRICS_PATH", "metrics.prom"),
+        help="Where to dump metrics when the client gets SIGUSR1"
+    )
+
+    parser.add_argument(
+        "--registration_timeout",
+        type=float,
+        default=os.getenv("REGISTRATION_TIMEOUT", registration.REGISTRATION_TIMEOUT),
+        help="Seconds to wait for the server when registering a new account"
+    )
+
+    parser.add_argument(
+        "--loop",
+        choices=network.EVENT_LOOPS,
+        default=os.getenv("EVENT_LOOP", "auto"),
+        help="Event loop for networking: uvloop if it is installed (auto), "
+             "the standard asyncio loop or uvloop"
+    )
+
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="Run networking and the history writer on a separate thread "
+             "so a busy window can not delay them"
+    )
+
+    parser.add_argument(
+        "-q",
+        "--queue",
+        type=queues.parse_queue_setting,
+        action="append",
+        default=[],
+        help="Queue capacity and policy, may be repeated. "
+             "For example: messages=1000:drop_oldest. "
+             f"Queues: {', '.join(QUEUE_DEFAULTS)}. "
+             f"Policies: {', '.join(queues.QUEUE_POLICIES)}"
+    )
+
+    return parser.parse_args()
+
+
+async def collect_history_batch(
         history_message_queue,
-        get_host,
-        get_port,
-        status_updates_queue,
-        watchdog_queue):
+        batch_size,
+        batch_bytes,
+        flush_interval,
+        idle_timeout=None):
 
-    status_updates_queue.put_nowait(gui.ReadConnectionStateChanged.INITIATED)
+    try:
+        async with timeout(idle_timeout):
+            msg = await history_message_queue.get()
+    except asyncio.TimeoutError:
+        return []
 
-    async with create_chat_connection(get_host, get_port) as (reader, writer):
-        status_updates_queue.put_nowait(
-            gui.ReadConnectionStateChanged.ESTABLISHED)
+    messages = [msg]
+    batch_length = len(msg.raw)
 
-        while True:
-            message = await reader.readline()
+    try:
+        async with timeout(flush_interval):
+            while len(messages) < batch_size and batch_length < batch_bytes:
+                msg = await history_message_queue.get()
+                messages.append(msg)
+                batch_length += len(msg.raw)
+    except asyncio.TimeoutError:
+        pass
 
-            messages_queue.put_nowait(
-                escape_stickiness_removed(message.decode()))
+    return messages
 
-            history_message_queue.put_nowait(message.decode())
 
-            watchdog_queue.put_nowait("New chat message")
+def write_history_batch(file, messages, fsync, history_store):
+    file_offset = file.tell()
+    file.write(b''.join(message.raw for message in messages))
 
+    # по смещениям окно чата знает, с какого места подгружать историю
+    offset = file_offset
+    for message in messages:
+        message.offset = offset
+        offset += len(message.raw)
 
-async def authorise(account_hash, post_reader, post_writer):
-    data = await post_reader.read(200)
+    file.flush()
+    if fsync:
+        os.fsync(file.fileno())
 
-    post_writer.write((account_hash + "\n").encode())
+    if history_store:
+        history_store.add_messages(messages, file_offset)
 
-    data = await post_reader.read(200)
 
-    if json.loads(data.decode().split("\n")[0]) is None:
-        raise Invalidtoken
+async def archive_history(history_store, history_logger):
+    started_at = time.monotonic()
+    try:
+        imported = await asyncio.to_thread(history_store.catch_up, os.cpu_count())
+    except asyncio.CancelledError:
+        # поток переноса не отменить, просим его остановиться после куска
+        history_store.stopping = True
+        raise
+    except Exception:
+        # без архива чат работает, закрывать из-за него окно незачем
+        history_logger.exception('Archiving the history file failed')
+        return
+
+    history_logger.info(
+        'Archived %d messages from the history file in %.1f s',
+        imported,
+        time.monotonic() - started_at
+    )
+
+
+async def save_messages(
+        history_message_queue,
+        history_path,
+        history_logger,
+        batch_size=500,
+        batch_bytes=64 * 1024,
+        flush_interval=0.2,
+        fsync_policy='none',
+        fsync_interval=5,
+        history_store=None):
+
+    last_fsync = time.monotonic()
+    unsynced = False
+
+    # строки от сервера пишем как есть, без повторного кодирования
+    with open(history_path, 'ab') as file:
+        while True:
+            idle_timeout = None
+            if fsync_policy == 'interval' and unsynced:
+                idle_timeout = max(
+                    last_fsync + fsync_interval - time.monotonic(), 0)
+
+            messages = await collect_history_batch(
+                history_message_queue,
+                batch_size,
+                batch_bytes,
+                flush_interval,
+                idle_timeout
+            )
+            collected_at = time.monotonic()
+            dequeued_at = time.perf_counter()
 
-    nickname = json.loads(data.decode().split("\n")[0])['nickname']
+            fsync = fsync_policy == 'batch' or (
+                fsync_policy == 'interval'
+                and collected_at - last_fsync >= fsync_interval
+            )
 
-    return nickname
+            # вся пачка пишется одним вызовом в одном потоке из пула,
+            # а в архив одной транзакцией
+            await asyncio.to_thread(
+                write_history_batch,
+                file,
+                messages,
+                fsync,
+                history_store
+            )
 
+            metrics.observe_batch(
+                messages, 'history_queue', 'history_write', dequeued_at)
+
+            if fsync:
+                last_fsync = time.monotonic()
+            unsynced = fsync_policy == 'interval' and not fsync
+
+            if messages:
+                # отставание записи - возраст самого старого сообщения пачки,
+                # а не время самой записи: так видно, что запись не успевает
+                history_logger.debug(
+                    'Saved %d messages, writer lag %.3f s, queue depth %d',
+                    len(messages),
+                    time.time() - messages[0].received_at,
+                    history_message_queue.qsize()
+                )
 
-async def send_messages(
+
+async def authorise(account_hash, post_reader, post_writer):
+    handshake = protocol.Handshake(post_reader, post_writer)
+    account = await handshake.authorise(account_hash)
+
+    if account is None:
+        raise Invalidtoken
+
+    return account['nickname']
+
+
+async def open_sending_connection(
         post_host,
         post_port,
         account_hash,
+        keepalive_idle):
+
+    post_reader, post_writer = await protocol.open_connection(post_host, post_port)
+
+    if keepalive_idle:
+        network.enable_keepalive(post_writer, keepalive_idle)
+
+    try:
+        nickname = await authorise(account_hash, post_reader, post_writer)
+    except BaseException:
+        post_writer.close()
+        raise
+
+    return post_reader, post_writer, nickname
+
+
+async def write_messages(post_writer, messages, chat_outbox, pending_replies):
+    chat_outbox.take(messages[-1].seq)
+
+    post_writer.writelines([
+        protocol.encode_message(message.text)
+        for message in messages
+    ])
+    # сервер отвечает на сообщения по порядку, по ответам и узнаем,
+    # какие из них дошли
+    pending_replies.extend(message.seq for message in messages)
+    await post_writer.drain()
+
+
+def acknowledge_replies(chat_outbox, pending_replies, count):
+    acknowledged_seq = None
+    for _ in range(min(count, len(pending_replies))):
+        seq = pending_replies.popleft()
+        # None - ответ на пинг
+        if seq is not None:
+            acknowledged_seq = seq
+
+    if acknowledged_seq is not None:
+        chat_outbox.acknowledge(acknowledged_seq)
+
+
+async def send_messages(
+        post_reader,
+        post_writer,
         sending_queue,
         status_updates_queue,
-        watchdog_queue):
-
-    status_updates_queue.put_nowait(
-        gui.SendingConnectionStateChanged.INITIATED)
+        chat_outbox,
+        monitor,
+        ping_interval):
 
-    async with create_chat_connection(post_host, post_port) as (post_reader, post_writer):
-        status_updates_queue.put_nowait(
-            gui.SendingConnectionStateChanged.ESTABLISHED)
+    monitor.touch()
+    # drain() ждёт, пока буфер отправки не опустится ниже нижней границы
+    post_writer.transport.set_write_buffer_limits(
+        high=WRITE_BUFFER_HIGH, low=WRITE_BUFFER_LOW)
 
-        watchdog_queue.put_nowait("Prompt before auth")
+    # на что ещё ждём ответа: seq сообщения или None для пинга
+    pending_replies = deque()
 
-        try:
-            nickname = await authorise(account_hash, post_reader, post_writer)
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            network.read_acknowledgements,
+            post_reader,
+            monitor,
+            functools.partial(acknowledge_replies, chat_outbox, pending_replies)
+        )
 
-        except Invalidtoken:
-            messagebox.showerror(
-                "Неверный токен",
-                "Проверьте токен, сервер его не узнал."
-            )
-            exit(0)
+        if ping_interval:
+            task_group.start_soon(
+                network.ping_server, post_writer, monitor, ping_interval, pending_replies)
 
-        status_updates_queue.put_nowait(gui.NicknameReceived(nickname))
-        watchdog_queue.put_nowait("Authorization done")
+        # сообщения, которые не успели уйти до обрыва или падения программы
+        in_flight = chat_outbox.in_flight()
+        for start in range(0, len(in_flight), SEND_BATCH_SIZE):
+            batch = in_flight[start:start + SEND_BATCH_SIZE]
+            await write_messages(post_writer, batch, chat_outbox, pending_replies)
 
         while True:
             message = await sending_queue.get()
+            messages = queues.drain_queue(sending_queue, message, SEND_BATCH_SIZE)
 
-            message = escape_stickiness_removed(message)
+            await write_messages(post_writer, messages, chat_outbox, pending_replies)
 
-            post_writer.write((message + "\n\n").encode())
+            status_updates_queue.put_nowait(events.SendingStatsChanged(
+                sending_queue.qsize(),
+                time.monotonic() - messages[0].queued_at
+            ))
 
-            watchdog_queue.put_nowait("Message sent")
 
-
-async def handle_connection(
-        get_host,
-        get_port,
+async def keep_sending(
         post_host,
         post_port,
-        history_path,
         account_hash,
-        watchdog_logger,
         sending_queue,
-        messages_queue,
-        watchdog_queue,
         status_updates_queue,
-        history_message_queue):
-
-    while True:
-        try:
-            async with create_task_group() as task_group:
-                task_group.start_soon(
-                    read_messages,
-                    messages_queue,
-                    history_message_queue,
-                    get_host,
-                    get_port,
-                    status_updates_queue,
-                    watchdog_queue
-                )
+        chat_outbox,
+        watchdog_logger,
+        watchdog_timeout,
+        keepalive_idle,
+        ping_interval,
+        use_standby):
 
-                task_group.start_soon(
-                    send_messages,
-                    post_host,
-                    post_port,
-                    account_hash,
-                    sending_queue,
-                    status_updates_queue,
-                    watchdog_queue
-                )
+    monitor = network.LivenessMonitor()
+    backoff = network.Backoff()
 
-                task_group.start_soon(
-                    watch_for_connection,
-                    watchdog_queue,
-                    watchdog_logger
-                )
+    connect = functools.partial(
+        open_sending_connection,
+        post_host,
+        post_port,
+        account_hash,
+        keepalive_idle
+    )
+    standby = network.StandbyConnection(connect)
 
-                task_group.start_soon(
-                    save_messages,
-                    history_message_queue,
-                    history_path
-                )
+    try:
+        while True:
+            status_updates_queue.put_nowait(
+                events.SendingConnectionStateChanged.INITIATED)
 
-        except BaseException as e:
-            if isinstance(e, ConnectionError):
-                status_updates_queue.put_nowait(
-                    gui.ReadConnectionStateChanged.CLOSED)
+            try:
+                post_reader, post_writer, nickname = await standby.take()
 
                 status_updates_queue.put_nowait(
-                    gui.SendingConnectionStateChanged.CLOSED)
-
+                    events.SendingConnectionStateChanged.ESTABLISHED)
+                status_updates_queue.put_nowait(events.NicknameReceived(nickname))
+                backoff.reset()
+
+                # запасное соединение уже авторизовано, поэтому при обрыве
+                # отправка переключается на него без нового рукопожатия
+                if use_standby:
+                    standby.prepare()
+
+                try:
+                    async with create_task_group() as task_group:
+                        task_group.start_soon(
+                            send_messages,
+                            post_reader,
+                            post_writer,
+                            sending_queue,
+                            status_updates_queue,
+                            chat_outbox,
+                            monitor,
+                            ping_interval
+                        )
+
+                        if ping_interval:
+                            task_group.start_soon(
+                                network.watch_for_connection,
+                                monitor,
+                                watchdog_logger,
+                                watchdog_timeout
+                            )
+                finally:
+                    post_writer.close()
+
+            except Invalidtoken:
+                # окно покажет ошибку и закроет программу из своего потока
+                status_updates_queue.put_nowait(events.TokenRejected())
+                return
+
+            except Exception as error:
+                if not network.is_connection_error(error):
+                    raise
+
+            status_updates_queue.put_nowait(
+                events.SendingConnectionStateChanged.CLOSED)
+
+            if standby.is_ready():
+                watchdog_logger.warning('Send connection lost. Switching to standby')
                 continue
 
-            if isinstance(e, asyncio.CancelledError):
-                break
+            delay = backoff.next_delay()
+            watchdog_logger.warning('Send connection lost. Reconnecting in %.1f s', delay)
+            await asyncio.sleep(delay)
+
+    finally:
+        standby.close()
+
+
+async def handle_connection(
+        get_host,
+        get_port,
+        post_host,
+        post_port,
+        account_hash,
+        watchdog_logger,
+        sending_queue,
+        messages_queue,
+        status_updates_queue,
+        history_message_queue,
+        chat_outbox,
+        replay_filter,
+        watchdog_timeout,
+        ping_interval,
+        keepalive_idle,
+        use_standby):
+
+    # чтение и отправка переподключаются независимо друг от друга
+    async with create_task_group() as task_group:
+        task_group.start_soon(
+            reading.keep_reading,
+            get_host,
+            get_port,
+            messages_queue,
+            history_message_queue,
+            status_updates_queue,
+            replay_filter,
+            watchdog_logger,
+            watchdog_timeout,
+            keepalive_idle
+        )
+
+        task_group.start_soon(
+            keep_sending,
+            post_host,
+            post_port,
+            account_hash,
+            sending_queue,
+            status_updates_queue,
+            chat_outbox,
+            watchdog_logger,
+            watchdog_timeout,
+            keepalive_idle,
+            ping_interval,
+            use_standby
+        )
 
 
-async def main(account_hash):
+async def main(account_hash, settings, gui_handoff=None):
+    # tkinter и sqlite3 индекса поиска грузятся только здесь: бенчмарки
+    # берут из этого модуля сетевой код без окна, а окну регистрации
+    # они не нужны
+    import gui
+    import search
+
     formatter = UnixTimeFormatter(
         '%(asctime)s %(name)s %(levelname)s: %(message)s'
     )
@@ -268,8 +682,9 @@ async def main(account_hash):
 
     logging.basicConfig(level=logging.DEBUG, handlers=[handler,])
     watchdog_logger = logging.getLogger('watchdog')
-
-    settings = get_settings()
+    history_logger = logging.getLogger('history')
+    queues_logger = logging.getLogger('queues')
+    metrics_logger = logging.getLogger('metrics')
 
     get_host = settings.get_host
     get_port = settings.get_port
@@ -279,27 +694,141 @@ async def main(account_hash):
 
     history_path = settings.history_path
 
-    history_message_queue = asyncio.Queue()
-    messages_queue = asyncio.Queue()
-    sending_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-    watchdog_queue = asyncio.Queue()
-
-    if os.path.exists(history_path):
-        with open(history_path, 'r') as file:
-            while True:
-                msg = file.readline()
-                if msg:
-                    messages_queue.put_nowait(escape_stickiness_removed(msg))
-                else:
-                    break
+    chat_queues = queues.create_queues(QUEUE_DEFAULTS, settings.queue)
+    if gui_handoff is not None:
+        # окно в другом потоке забирает сообщения и статусы из кольцевых буферов
+        chat_queues['messages'] = queues.RingBuffer(chat_queues['messages'].maxsize)
+        chat_queues['status'] = queues.RingBuffer(STATUS_RING_SIZE)
+
+    history_message_queue = chat_queues['history']
+    messages_queue = chat_queues['messages']
+    sending_queue = chat_queues['sending']
+    status_updates_queue = chat_queues['status']
+
+    chat_outbox = outbox.Outbox(settings.outbox_path)
+    pending_count = chat_outbox.load()
+    if pending_count:
+        logging.info('Resending %d messages from the outbox', pending_count)
+
+    replay_filter = history.ReplayFilter(settings.dedup_window, settings.server_backlog)
+    replay_filter.seed(history_path)
+
+    history_pager = history.HistoryPager(history_path, settings.history_tail)
+    history_index = search.HistoryIndex(history_path)
+
+    history_store = None
+    if settings.history_store == 'sqlite':
+        import store
+
+        history_store = store.HistoryStore(
+            settings.history_db or f'{history_path}.db')
+
+    if history_store and history_store.is_up_to_date(history_path):
+        # последние сообщения берём одним запросом по индексу,
+        # а более старые страницы дочитываем из файла с этого места
+        tail = history_store.last_messages(settings.history_tail)
+        history_pager.top_offset = tail[0][0] if tail else 0
+    else:
+        if history_store:
+            # архив отстал от файла, например при первом запуске с
+            # --history_store sqlite: переносим в фоне, а хвост берём из файла
+            history_store.begin_catch_up(history_path)
+        tail = history_pager.read_tail()
+
+    for offset, text in tail:
+        message = history.ChatMessage.from_text(text)
+        message.offset = offset
+        messages_queue.put_nowait(message)
+
+    metrics.tracer.sample_every = settings.trace_sample
+    if gui_handoff is None:
+        metrics.dump_metrics_on_signal(
+            settings.metrics_path, chat_queues, metrics_logger)
 
     async with create_task_group() as task_group:
+        if settings.metrics_port:
+            task_group.start_soon(
+                metrics.serve_metrics,
+                settings.metrics_host,
+                settings.metrics_port,
+                chat_queues,
+                metrics_logger
+            )
+
         task_group.start_soon(
-            gui.draw,
-            messages_queue,
-            sending_queue,
-            status_updates_queue
+            queues.log_queue_stats,
+            chat_queues,
+            queues_logger
+        )
+
+        if gui_handoff is None:
+            task_group.start_soon(
+                gui.draw,
+                messages_queue,
+                sending_queue,
+                status_updates_queue,
+                history_pager,
+                settings.max_lines,
+                chat_outbox,
+                history_index
+            )
+        else:
+            loop = asyncio.get_running_loop()
+
+            def start_gui(is_network_alive):
+                metrics.dump_metrics_on_signal(
+                    settings.metrics_path, chat_queues, metrics_logger)
+                try:
+                    gui.draw_threaded(
+                        messages_queue,
+                        status_updates_queue,
+                        functools.partial(
+                            submit_from_gui_thread,
+                            loop,
+                            sending_queue,
+                            chat_outbox
+                        ),
+                        history_pager,
+                        settings.max_lines,
+                        history_index,
+                        is_network_alive
+                    )
+                finally:
+                    if is_network_alive():
+                        loop.call_soon_threadsafe(task_group.cancel_scope.cancel)
+
+            # окно запустится в главном потоке, этот поток занят только сетью
+            gui_handoff.put(start_gui)
+
+        task_group.start_soon(
+            search.keep_index_updated,
+            history_index
+        )
+
+        task_group.start_soon(
+            outbox.sync_outbox,
+            chat_outbox,
+            settings.outbox_fsync_interval
+        )
+
+        if history_store and history_store.catching_up:
+            task_group.start_soon(
+                archive_history,
+                history_store,
+                history_logger
+            )
+
+        task_group.start_soon(
+            save_messages,
+            history_message_queue,
+            history_path,
+            history_logger,
+            settings.history_batch_size,
+            settings.history_batch_bytes,
+            settings.history_flush_interval,
+            settings.history_fsync,
+            settings.history_fsync_interval,
+            history_store
         )
 
         task_group.start_soon(
@@ -308,50 +837,120 @@ async def main(account_hash):
             get_port,
             post_host,
             post_port,
-            history_path,
             account_hash,
             watchdog_logger,
             sending_queue,
             messages_queue,
-            watchdog_queue,
             status_updates_queue,
-            history_message_queue
+            history_message_queue,
+            chat_outbox,
+            replay_filter,
+            settings.watchdog_timeout,
+            settings.ping_interval,
+            settings.keepalive_idle,
+            settings.standby
         )
 
 
-def check_for_registration():
-    auth_file_path = "auth.json"
-    settings = get_settings()
+def submit_from_gui_thread(loop, sending_queue, chat_outbox, text):
+    # журнал и очередь отправки меняет только сетевой поток
+    if sending_queue.full():
+        return False
 
-    token = settings.token
+    loop.call_soon_threadsafe(
+        outbox.enqueue_message, sending_queue, chat_outbox, text)
+    return True
 
-    post_host = settings.post_host
-    post_port = settings.post_port
 
-    if token:
-        account_hash = token
+def run_network_thread(account_hash, settings, gui_handoff):
+    try:
+        run(
+            main,
+            account_hash,
+            settings,
+            gui_handoff,
+            backend_options=network.get_backend_options(settings.loop)
+        )
+    except BaseException:
+        logging.exception("Network thread stopped")
+    finally:
+        # если сеть остановилась раньше, чем открылось окно, не ждём его
+        gui_handoff.put(None)
+
 
-    elif os.path.exists(auth_file_path):
-        with open(auth_file_path, 'r') as file:
-            account_data = file.read()
-            account_hash = json.loads(account_data)['account_hash']
-    else:
-        registration.draw(auth_file_path, post_host, post_port)
+def run_threaded(account_hash, settings):
+    gui_handoff = queue.Queue()
+    network_thread = threading.Thread(
+        target=run_network_thread,
+        args=(account_hash, settings, gui_handoff),
+        daemon=True
+    )
+    network_thread.start()
 
-        try:
-            with open(auth_file_path, 'r') as file:
-                account_data = file.read()
-                account_hash = json.loads(account_data)['account_hash']
+    start_gui = gui_handoff.get()
+    if start_gui is None:
+        return
+
+    start_gui(network_thread.is_alive)
+    network_thread.join(NETWORK_THREAD_JOIN_TIMEOUT)
+
+
+def read_account_hash(auth_file_path):
+    if not os.path.exists(auth_file_path):
+        return None
+
+    with open(auth_file_path, 'r') as file:
+        account_data = file.read()
+        return json.loads(account_data)['account_hash']
 
-        except FileNotFoundError:
-            messagebox.showerror(
-                "Регистрация",
-                "Произошла ошибка при регистрации. Попробуйте ещё раз."
-            )
-            exit(0)
+
+async def get_account_hash(auth_file_path, settings):
+    account_hash = settings.token or read_account_hash(auth_file_path)
+
+    if not account_hash:
+        # окно регистрации работает на том же цикле событий, что и чат
+        await registration.draw(
+            auth_file_path,
+            settings.post_host,
+            settings.post_port,
+            settings.registration_timeout
+        )
+        account_hash = read_account_hash(auth_file_path)
+
+    if not account_hash:
+        from tkinter import messagebox
+
+        messagebox.showerror(
+            "Регистрация",
+            "Произошла ошибка при регистрации. Попробуйте ещё раз."
+        )
+
+    return account_hash
+
+
+async def register_and_run(auth_file_path, settings):
+    account_hash = await get_account_hash(auth_file_path, settings)
+    if account_hash:
+        await main(account_hash, settings)
+
+
+def check_for_registration():
+    auth_file_path = "auth.json"
+    # настройки разбираются один раз и дальше передаются во все функции
+    settings = get_settings()
 
     try:
-        run(main, account_hash)
+        if settings.threaded:
+            account_hash = run(get_account_hash, auth_file_path, settings)
+            if account_hash:
+                run_threaded(account_hash, settings)
+        else:
+            run(
+                register_and_run,
+                auth_file_path,
+                settings,
+                backend_options=network.get_backend_options(settings.loop)
+            )
     except asyncio.CancelledError:
         logging.info("Program interrupted by user")
     except BaseException:
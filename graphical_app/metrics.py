@@ -0,0 +1,146 @@
+import time
+import signal
+import asyncio
+import itertools
+from bisect import bisect_left
+
+
+# границы корзин гистограмм в секундах: от 0.1 мс до ~13 с, каждая вдвое больше
+BUCKET_BOUNDS = tuple(0.0001 * 2 ** power for power in range(18))
+
+STAGES = (
+    # от reader.readline() до того, как сообщение легло в обе очереди
+    'read',
+    # ожидание в очереди окна чата и вставка в окно
+    'gui_queue',
+    'gui_render',
+    # ожидание в очереди истории и запись пачки на диск
+    'history_queue',
+    'history_write',
+)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Tracer:
+    def __init__(self, sample_every=0):
+        self.sample_every = sample_every
+        self.counter = itertools.count()
+        self.histograms = {stage: Histogram() for stage in STAGES}
+
+    def start(self):
+        # когда трассировка выключена, это одна проверка на сообщение
+        if not self.sample_every or next(self.counter) % self.sample_every:
+            return None
+        return time.perf_counter()
+
+    def observe(self, stage, started_at, finished_at=None):
+        if finished_at is None:
+            finished_at = time.perf_counter()
+        self.histograms[stage].observe(finished_at - started_at)
+
+
+tracer = Tracer()
+
+
+def observe_batch(messages, queue_stage, work_stage, dequeued_at):
+    if not tracer.sample_every:
+        return
+
+    finished_at = time.perf_counter()
+    for message in messages:
+        if message.trace is not None:
+            tracer.observe(queue_stage, message.trace, dequeued_at)
+            tracer.observe(work_stage, dequeued_at, finished_at)
+
+
+def render_metrics(chat_queues=None):
+    lines = [
+        '# HELP minechat_stage_seconds Time a message spends in a pipeline stage',
+        '# TYPE minechat_stage_seconds histogram',
+    ]
+    for stage, histogram in tracer.histograms.items():
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS, histogram.counts):
+            cumulative += count
+            lines.append(
+                f'minechat_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} '
+                f'{cumulative}'
+            )
+        lines.append(
+            f'minechat_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} '
+            f'{histogram.count}'
+        )
+        lines.append(f'minechat_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'minechat_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+    queue_stats = {
+        name: queue.stats() for name, queue in (chat_queues or {}).items()
+    }
+    for key in ('size', 'maxsize', 'high_water', 'dropped'):
+        if not queue_stats:
+            break
+        metric_type = 'counter' if key == 'dropped' else 'gauge'
+        lines.append(f'# TYPE minechat_queue_{key} {metric_type}')
+        for name, stats in queue_stats.items():
+            lines.append(f'minechat_queue_{key}{{queue="{name}"}} {stats[key]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(host, port, chat_queues, logger):
+    async def handle_request(reader, writer):
+        try:
+            # тело запроса не нужно, дочитываем заголовки и отвечаем
+            while (await reader.readline()).strip():
+                pass
+
+            body = render_metrics(chat_queues).encode()
+            writer.write(
+                b'HTTP/1.0 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4\r\n'
+                + f'Content-Length: {len(body)}\r\n\r\n'.encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_request, host, port)
+    logger.info('Metrics on http://%s:%d/metrics', host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.close()
+
+
+def dump_metrics(metrics_path, chat_queues, logger):
+    with open(metrics_path, 'w') as file:
+        file.write(render_metrics(chat_queues))
+    logger.info('Metrics dumped to %s', metrics_path)
+
+
+def dump_metrics_on_signal(metrics_path, chat_queues, logger):
+    # на Windows нет SIGUSR1. Обработчик ставится из главного потока,
+    # даже когда сеть работает в отдельном
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: dump_metrics(metrics_path, chat_queues, logger)
+    )
@@ -0,0 +1,203 @@
+import time
+import random
+import socket
+import asyncio
+
+
+DNS_CACHE_TTL = 300
+EVENT_LOOPS = ('auto', 'asyncio', 'uvloop')
+ACKNOWLEDGEMENTS_READ_SIZE = 64 * 1024
+
+resolved_addresses = {}
+
+
+class LivenessMonitor:
+    def __init__(self):
+        self.last_seen = time.monotonic()
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def silence(self):
+        return time.monotonic() - self.last_seen
+
+
+async def watch_for_connection(monitor, watchdog_logger, timeout, check_interval=None):
+    monitor.touch()
+    check_interval = check_interval or timeout / 4
+
+    while True:
+        await asyncio.sleep(check_interval)
+
+        silence = monitor.silence()
+        if silence > timeout:
+            watchdog_logger.warning(
+                'No activity for %.1f s. Reconnecting...', silence)
+            raise ConnectionError
+
+
+def enable_keepalive(writer, idle=10, interval=5, count=3):
+    sock = writer.get_extra_info('socket')
+    if sock is None:
+        return
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+    if hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+
+
+async def read_acknowledgements(post_reader, monitor, on_replies):
+    # сервер отвечает строкой на каждое отправленное сообщение и пинг
+    while True:
+        response = await post_reader.read(ACKNOWLEDGEMENTS_READ_SIZE)
+        if not response:
+            raise ConnectionError
+        monitor.touch()
+
+        replies = response.count(b'\n')
+        if replies:
+            on_replies(replies)
+
+
+async def ping_server(post_writer, monitor, interval, pending_replies):
+    while True:
+        await asyncio.sleep(interval)
+        if monitor.silence() < interval:
+            continue
+
+        # пустая строка - пустое сообщение, сервер ответит на неё одной строкой
+        post_writer.write(b'\n')
+        pending_replies.append(None)
+        await post_writer.drain()
+
+
+class Backoff:
+    def __init__(self, initial=0.5, maximum=30, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = initial
+
+    def reset(self):
+        self.delay = self.initial
+
+    def next_delay(self):
+        # full jitter: клиенты не переподключаются к серверу все разом
+        delay = random.uniform(0, self.delay)
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+
+def is_connection_error(error):
+    errors = getattr(error, 'exceptions', None)
+    if errors:
+        return all(is_connection_error(nested_error) for nested_error in errors)
+
+    return isinstance(error, (OSError, EOFError, asyncio.TimeoutError))
+
+
+async def resolve(host, port):
+    cached = resolved_addresses.get((host, port))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    loop = asyncio.get_running_loop()
+    address_infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = [address_info[4][:2] for address_info in address_infos]
+
+    resolved_addresses[(host, port)] = (time.monotonic() + DNS_CACHE_TTL, addresses)
+    return addresses
+
+
+async def open_connection(host, port, **kwargs):
+    last_error = None
+    for address, resolved_port in await resolve(host, port):
+        try:
+            return await asyncio.open_connection(address, resolved_port, **kwargs)
+        except OSError as error:
+            last_error = error
+
+    # адрес мог смениться, в следующий раз спросим DNS заново
+    resolved_addresses.pop((host, port), None)
+    raise last_error or ConnectionError(f'Can not resolve {host}')
+
+
+class StandbyConnection:
+    def __init__(self, connect):
+        self.connect = connect
+        self.task = None
+
+    def prepare(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.connect())
+
+    def is_ready(self):
+        return (
+            self.task is not None
+            and self.task.done()
+            and not self.task.cancelled()
+            and self.task.exception() is None
+        )
+
+    async def take(self):
+        if self.task is None:
+            return await self.connect()
+
+        task, self.task = self.task, None
+        return await task
+
+    def close(self):
+        if self.task is None:
+            return
+
+        if self.is_ready():
+            writer = self.task.result()[1]
+            writer.close()
+        else:
+            self.task.cancel()
+        self.task = None
+
+
+def choose_event_loop(name):
+    # auto - uvloop, если он установлен, иначе обычный цикл asyncio
+    if name == 'asyncio':
+        return 'asyncio'
+
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        if name == 'uvloop':
+            raise RuntimeError('uvloop is not installed: pip install uvloop')
+        return 'asyncio'
+
+    return 'uvloop'
+
+
+def get_backend_options(name):
+    # для anyio.run(..., backend_options=...)
+    return {'use_uvloop': choose_event_loop(name) == 'uvloop'}
+
+
+def run_coroutine(coroutine, name='auto'):
+    # замена asyncio.run с выбором цикла событий; через политику,
+    # потому что loop_factory у asyncio появился только в Python 3.11
+    if choose_event_loop(name) == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(None)
+
+    return asyncio.run(coroutine)
@@ -0,0 +1,133 @@
+import os
+import json
+import asyncio
+from collections import OrderedDict
+
+import events
+import protocol
+
+
+class Outbox:
+    def __init__(self, path, compact_threshold=1000):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.pending = OrderedDict()
+        self.next_seq = 1
+        self.taken_seq = 0
+        self.acknowledged_since_compaction = 0
+        self.unsynced = False
+        self.file = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # строка могла не дописаться при падении программы
+                        continue
+
+                    if 'ack' in record:
+                        self.forget_acknowledged(record['ack'])
+                    else:
+                        self.pending[record['seq']] = events.OutgoingMessage(
+                            record['text'], record['seq'])
+                        self.next_seq = record['seq'] + 1
+
+        # всё, что осталось в журнале с прошлого запуска, отправим заново
+        self.taken_seq = self.next_seq - 1
+        self.compact()
+        return len(self.pending)
+
+    def write_record(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.unsynced = True
+
+    def append(self, text):
+        message = events.OutgoingMessage(text, self.next_seq)
+        self.next_seq += 1
+
+        self.write_record({'seq': message.seq, 'text': text})
+        self.pending[message.seq] = message
+        return message
+
+    def take(self, seq):
+        self.taken_seq = max(self.taken_seq, seq)
+
+    def in_flight(self):
+        return [
+            message for seq, message in self.pending.items()
+            if seq <= self.taken_seq
+        ]
+
+    def forget_acknowledged(self, seq):
+        while self.pending and next(iter(self.pending)) <= seq:
+            self.pending.popitem(last=False)
+            self.acknowledged_since_compaction += 1
+
+    def acknowledge(self, seq):
+        self.forget_acknowledged(seq)
+
+        # переписываем журнал не чаще, чем раз в len(pending) подтверждений,
+        # чтобы сжатие в среднем стоило O(1) на сообщение
+        compact_after = max(self.compact_threshold, len(self.pending))
+        if self.acknowledged_since_compaction >= compact_after:
+            self.compact()
+        else:
+            self.write_record({'ack': seq})
+
+    def compact(self):
+        if self.file:
+            self.file.close()
+
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for seq, message in self.pending.items():
+                record = {'seq': seq, 'text': message.text}
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            # иначе после падения системы на месте журнала может оказаться
+            # пустой файл
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.acknowledged_since_compaction = 0
+        self.unsynced = True
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def enqueue_message(sending_queue, outbox, text):
+    if not protocol.sanitize_text(text):
+        # пустое сообщение сервер не покажет, отправлять нечего
+        return True
+
+    if sending_queue.full():
+        return False
+
+    # сначала в журнал на диске, чтобы сообщение пережило падение программы
+    message = outbox.append(text)
+    sending_queue.put_nowait(message)
+    return True
+
+
+async def sync_outbox(outbox, interval):
+    # fsync раз в interval секунд, чтобы не тормозить набор сообщений
+    while True:
+        await asyncio.sleep(interval)
+        if not outbox.unsynced:
+            continue
+
+        outbox.unsynced = False
+        # копия дескриптора остаётся рабочей, даже если журнал сожмут,
+        # пока fsync выполняется в другом потоке
+        descriptor = os.dup(outbox.file.fileno())
+        try:
+            await asyncio.to_thread(os.fsync, descriptor)
+        finally:
+            os.close(descriptor)
@@ -0,0 +1,168 @@
+import json
+import asyncio
+from enum import Enum
+from contextlib import asynccontextmanager
+
+from async_timeout import timeout
+
+import history
+import network
+
+
+# лимит буфера StreamReader: по умолчанию он 64 КБ, и более длинная строка
+# в чате роняла readline() с LimitOverrunError
+STREAM_LIMIT = 1024 * 1024
+READ_SIZE = 256 * 1024
+HANDSHAKE_STEP_TIMEOUT = 10
+
+
+class HandshakeStep(Enum):
+    GREETING = 'приветствие сервера'
+    ACCOUNT = 'данные аккаунта'
+    WELCOME = 'приглашение в чат'
+    NICKNAME_PROMPT = 'запрос имени'
+    REGISTERED = 'новый аккаунт'
+    DONE = 'готово'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class HandshakeError(ConnectionError):
+    def __init__(self, step, message):
+        super().__init__(f'{message}: {step.value}')
+        self.step = step
+
+
+class HandshakeTimeout(HandshakeError):
+    def __init__(self, step):
+        super().__init__(step, 'Сервер не ответил вовремя')
+
+
+def sanitize_text(text):
+    # перевод строки внутри сообщения разбил бы его на несколько,
+    # и ответов сервера стало бы больше, чем отправленных сообщений
+    return history.escape_stickiness_removed(text.replace("\n", " "))
+
+
+def encode_line(text):
+    return (sanitize_text(text) + "\n").encode()
+
+
+def encode_message(text):
+    # пустая строка после сообщения говорит серверу, что оно закончилось
+    return (sanitize_text(text) + "\n\n").encode()
+
+
+async def open_connection(host, port, limit=STREAM_LIMIT):
+    return await network.open_connection(host, port, limit=limit)
+
+
+@asynccontextmanager
+async def create_chat_connection(host, port, limit=STREAM_LIMIT):
+    reader, writer = await open_connection(host, port, limit)
+    try:
+        yield reader, writer
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def read_line(reader):
+    # как readline(), но строку длиннее лимита буфера дочитывает по частям
+    chunks = []
+    while True:
+        try:
+            chunks.append(await reader.readuntil(b'\n'))
+            break
+        except asyncio.LimitOverrunError as error:
+            chunks.append(await reader.read(error.consumed))
+        except asyncio.IncompleteReadError as error:
+            chunks.append(error.partial)
+            break
+
+    return b''.join(chunks)
+
+
+class LineReader:
+    # Читает поток большими кусками и отдаёт все целые строки из куска,
+    # вместо одного await на каждую строку
+    def __init__(self, reader, read_size=READ_SIZE):
+        self.reader = reader
+        self.read_size = read_size
+        self.tail = b''
+
+    async def read_lines(self):
+        while True:
+            data = await self.reader.read(self.read_size)
+            if not data:
+                # недописанную строку отдаём как есть, дальше только пустой список
+                tail, self.tail = self.tail, b''
+                return [tail] if tail else []
+
+            data = self.tail + data
+            end = data.rfind(b'\n') + 1
+            self.tail = data[end:]
+            if end:
+                return history.split_lines(data[:end])
+
+
+class Handshake:
+    # Сервер ведёт диалог строками:
+    #   GREETING -> хеш аккаунта -> ACCOUNT (null, если хеш неверный) -> WELCOME
+    #   GREETING -> пустая строка -> NICKNAME_PROMPT -> имя -> REGISTERED
+    # Каждый шаг ждём не дольше step_timeout секунд
+    def __init__(self, reader, writer, step_timeout=HANDSHAKE_STEP_TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.step_timeout = step_timeout
+        self.step = HandshakeStep.GREETING
+
+    async def expect(self, step):
+        self.step = step
+        try:
+            async with timeout(self.step_timeout):
+                line = await read_line(self.reader)
+        except asyncio.TimeoutError:
+            raise HandshakeTimeout(step)
+
+        if not line:
+            raise HandshakeError(step, 'Сервер закрыл соединение')
+        return line.decode().strip()
+
+    async def expect_json(self, step):
+        line = await self.expect(step)
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise HandshakeError(step, f'Непонятный ответ сервера {line!r}')
+
+    async def authorise(self, account_hash):
+        await self.expect(HandshakeStep.GREETING)
+        self.writer.write(encode_line(account_hash))
+
+        account = await self.expect_json(HandshakeStep.ACCOUNT)
+        if account is None:
+            self.step = HandshakeStep.DONE
+            return None
+
+        await self.expect(HandshakeStep.WELCOME)
+        self.step = HandshakeStep.DONE
+        return account
+
+    async def register(self, username):
+        await self.expect(HandshakeStep.GREETING)
+        self.writer.write(b"\n")
+
+        prompt = await self.expect(HandshakeStep.NICKNAME_PROMPT)
+        if callable(username):
+            # имя можно спросить у пользователя, когда сервер его запросил
+            username = username(prompt)
+        self.writer.write(encode_line(username))
+
+        account = await self.expect_json(HandshakeStep.REGISTERED)
+        self.step = HandshakeStep.DONE
+        return account
@@ -0,0 +1,130 @@
+import asyncio
+from collections import deque
+
+
+QUEUE_POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+class ChatQueue(asyncio.Queue):
+    def __init__(self, maxsize=0, policy='block', key=type):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy: {policy}')
+
+        super().__init__(maxsize)
+        self.policy = policy
+        self.key = key
+        self.high_water = 0
+        self.dropped = 0
+
+    async def put(self, item):
+        if self.policy == 'block':
+            await super().put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item):
+        # из очереди статусов важен только последний статус каждого вида
+        if self.policy == 'coalesce' and self.replace_queued(item):
+            self.dropped += 1
+            return
+
+        if self.policy != 'block' and self.full():
+            self._queue.popleft()
+            self.task_done()
+            self.dropped += 1
+
+        super().put_nowait(item)
+        self.high_water = max(self.high_water, self.qsize())
+
+    def replace_queued(self, item):
+        key = self.key(item)
+        for index, queued_item in enumerate(self._queue):
+            if self.key(queued_item) == key:
+                self._queue[index] = item
+                return True
+        return False
+
+    def stats(self):
+        return {
+            'size': self.qsize(),
+            'maxsize': self.maxsize,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+        }
+
+
+class RingBuffer:
+    # Передача между потоками без блокировок: append и popleft у deque
+    # атомарны. Пишет один поток, читает другой; при переполнении
+    # теряются самые старые элементы
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque(maxlen=maxsize)
+        self.high_water = 0
+        self.dropped = 0
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if len(self.items) == self.maxsize:
+            self.dropped += 1
+        self.items.append(item)
+        self.high_water = max(self.high_water, len(self.items))
+
+    def drain(self, limit):
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.items.popleft())
+            except IndexError:
+                break
+        return items
+
+    def qsize(self):
+        return len(self.items)
+
+    def stats(self):
+        return {
+            'size': self.qsize(),
+            'maxsize': self.maxsize,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+        }
+
+
+def drain_queue(queue, first_item, limit):
+    items = [first_item]
+    while len(items) < limit and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def parse_queue_setting(text):
+    name, _, limits = text.partition('=')
+    size, _, policy = limits.partition(':')
+
+    if not name or not size.isdigit() or policy not in QUEUE_POLICIES + ('',):
+        raise ValueError(f'Bad queue setting: {text}')
+
+    return name, int(size), policy or None
+
+
+def create_queues(defaults, queue_settings):
+    limits = dict(defaults)
+    for name, size, policy in queue_settings:
+        if name not in limits:
+            raise ValueError(f'Unknown queue: {name}')
+        limits[name] = (size, policy or limits[name][1])
+
+    return {
+        name: ChatQueue(size, policy)
+        for name, (size, policy) in limits.items()
+    }
+
+
+async def log_queue_stats(queues, logger, interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        for name, queue in queues.items():
+            logger.debug('Queue %s: %s', name, queue.stats())
@@ -0,0 +1,105 @@
+import asyncio
+
+from anyio import create_task_group
+
+import events
+import metrics
+import history
+import network
+import protocol
+
+
+async def read_messages(
+        messages_queue,
+        history_message_queue,
+        get_host,
+        get_port,
+        status_updates_queue,
+        replay_filter,
+        monitor,
+        keepalive_idle,
+        backoff):
+
+    status_updates_queue.put_nowait(events.ReadConnectionStateChanged.INITIATED)
+
+    async with protocol.create_chat_connection(get_host, get_port) as (reader, writer):
+        status_updates_queue.put_nowait(
+            events.ReadConnectionStateChanged.ESTABLISHED)
+        backoff.reset()
+
+        if keepalive_idle:
+            network.enable_keepalive(writer, keepalive_idle)
+
+        # после подключения сервер заново присылает последние сообщения
+        replay_filter.start_replay()
+
+        line_reader = protocol.LineReader(reader)
+        while True:
+            lines = await line_reader.read_lines()
+            if not lines:
+                raise ConnectionError
+
+            monitor.touch()
+            replay_filter.on_read()
+
+            for line in lines:
+                # запись создаётся один раз и дальше передаётся по ссылке
+                message = history.ChatMessage(line)
+                message.trace = metrics.tracer.start()
+                if replay_filter.is_duplicate(message.text):
+                    continue
+
+                await messages_queue.put(message)
+
+                await history_message_queue.put(message)
+
+                if message.trace is not None:
+                    metrics.tracer.observe('read', message.trace)
+
+
+async def keep_reading(
+        get_host,
+        get_port,
+        messages_queue,
+        history_message_queue,
+        status_updates_queue,
+        replay_filter,
+        watchdog_logger,
+        watchdog_timeout,
+        keepalive_idle):
+
+    monitor = network.LivenessMonitor()
+    backoff = network.Backoff()
+
+    while True:
+        try:
+            async with create_task_group() as task_group:
+                task_group.start_soon(
+                    read_messages,
+                    messages_queue,
+                    history_message_queue,
+                    get_host,
+                    get_port,
+                    status_updates_queue,
+                    replay_filter,
+                    monitor,
+                    keepalive_idle,
+                    backoff
+                )
+
+                task_group.start_soon(
+                    network.watch_for_connection,
+                    monitor,
+                    watchdog_logger,
+                    watchdog_timeout
+                )
+
+        except Exception as error:
+            if not network.is_connection_error(error):
+                raise
+
+        status_updates_queue.put_nowait(events.ReadConnectionStateChanged.CLOSED)
+
+        delay = backoff.next_delay()
+        watchdog_logger.warning('Read connection lost. Reconnecting in %.1f s', delay)
+        await asyncio.sleep(delay)
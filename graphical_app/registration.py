@@ -1,13 +1,109 @@
+import os
+import re
 import json
+import time
 import asyncio
-import tkinter as tk
-from tkinter import ttk, messagebox
-from contextlib import asynccontextmanager
+import argparse
 
-import aiofiles
+from dotenv import load_dotenv
+from async_timeout import timeout
 
+import network
+import protocol
+
+
+REGISTRATION_TIMEOUT = 10
+# в имени файла оставляем только буквы, цифры, _ и -, чтобы имя вроде
+# ../x не вывело файл за пределы --output_dir
+UNSAFE_FILE_NAME_CHARS = re.compile(r'[^\w-]')
+
+
+def get_settings():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Register many chat accounts at once, for example for test bots',
+    )
+
+    parser.add_argument(
+        "-ph",
+        "--post_host",
+        type=str,
+        default=os.getenv("POST_HOST"),
+        help="Your host. For example: minechat.dvmn.org",
+    )
+
+    parser.add_argument(
+        "-pp",
+        "--post_port",
+        type=int,
+        default=os.getenv("POST_PORT"),
+        help="Your port. For example: 5050"
+    )
+
+    parser.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=10,
+        help="How many accounts to register"
+    )
+
+    parser.add_argument(
+        "--prefix",
+        type=str,
+        default="bot",
+        help="Nicknames are the prefix and a number. For example: bot1, bot2"
+    )
+
+    parser.add_argument(
+        "--names",
+        type=str,
+        help="File with one nickname per line, replaces --count and --prefix"
+    )
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=10,
+        help="How many registrations may run at the same time"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        default="auth",
+        help="Where to write auth files, one NICKNAME.json per account. "
+             "Existing files are never overwritten"
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=REGISTRATION_TIMEOUT,
+        help="Seconds to wait for one registration"
+    )
+
+    parser.add_argument(
+        "--loop",
+        choices=network.EVENT_LOOPS,
+        default=os.getenv("EVENT_LOOP", "auto"),
+        help="Event loop: uvloop if it is installed (auto), "
+             "the standard asyncio loop or uvloop"
+    )
+
+    return parser.parse_args()
+
+
+async def draw(auth_file_path, host, port, registration_timeout=REGISTRATION_TIMEOUT):
+    # окно нужно только графическому клиенту, пакетная регистрация
+    # работает без tkinter
+    import tkinter as tk
+    from tkinter import ttk
+
+    import gui
 
-def draw(auth_file_path, host, port):
     root = tk.Tk()
     root.title("Регистрация")
 
@@ -20,58 +116,201 @@ def draw(auth_file_path, host, port):
     username_entry = ttk.Entry(entry_frame)
     username_entry.grid(row=0, column=1, padx=5, pady=5)
 
-    register_button = ttk.Button(
-        root,
-        text="Зарегистрироваться",
-        command=lambda: asyncio.run(
-            register(root, username_entry.get(), auth_file_path, host, port)
-        )
-    )
-    register_button.pack(pady=10)
+    buttons_frame = ttk.Frame(root)
+    buttons_frame.pack(pady=10)
+
+    register_button = ttk.Button(buttons_frame, text="Зарегистрироваться")
+    register_button.pack(side="left", padx=5)
+
+    cancel_button = ttk.Button(buttons_frame, text="Отмена", state="disabled")
+    cancel_button.pack(side="left", padx=5)
 
     status_label = ttk.Label(root, text="")
     status_label.pack()
 
-    root.mainloop()
+    redraw_event = asyncio.Event()
+    registration_task = None
 
+    def set_status(text):
+        status_label['text'] = text
+        redraw_event.set()
 
-def escape_stickiness_removed(text):
-    return text.replace("\\n", " ").strip()
+    def set_registering(registering):
+        register_button['state'] = 'disabled' if registering else 'normal'
+        cancel_button['state'] = 'normal' if registering else 'disabled'
 
+    def start_registration():
+        nonlocal registration_task
+        # регистрация идёт на общем цикле событий, окно при этом не зависает
+        set_registering(True)
+        registration_task = asyncio.get_running_loop().create_task(register(
+            root,
+            username_entry.get(),
+            auth_file_path,
+            host,
+            port,
+            set_status,
+            set_registering,
+            registration_timeout
+        ))
+
+    def cancel_registration():
+        if registration_task and not registration_task.done():
+            registration_task.cancel()
+            set_registering(False)
+            set_status("Регистрация отменена")
+
+    register_button['command'] = start_registration
+    cancel_button['command'] = cancel_registration
 
-@asynccontextmanager
-async def create_chat_connection(host, port):
-    reader, writer = await asyncio.open_connection(host, port)
     try:
-        yield reader, writer
+        await gui.update_tk(root, redraw_event)
+    except gui.TkAppClosed:
+        pass
     finally:
-        writer.close()
-        await writer.wait_closed()
+        if registration_task:
+            registration_task.cancel()
+
 
+async def request_registration(username, host, port, set_status=None):
+    set_status = set_status or (lambda text: None)
+
+    set_status("Подключаемся к серверу...")
+    async with protocol.create_chat_connection(host, port) as (reader, writer):
+        set_status("Регистрируем имя...")
+        handshake = protocol.Handshake(reader, writer)
+        return await handshake.register(username)
+
+
+async def register(
+        root,
+        username,
+        auth_file_path,
+        host,
+        port,
+        set_status,
+        set_registering,
+        registration_timeout):
+
+    import aiofiles
+    from tkinter import messagebox
 
-async def register(root, username, auth_file_path, host, port):
     try:
-        async with create_chat_connection(host, port) as (reader, writer):
-            data = await reader.read(100)
+        async with timeout(registration_timeout):
+            auth_data = await request_registration(
+                username, host, port, set_status)
+
+        set_status("Сохраняем токен...")
+        async with aiofiles.open(auth_file_path, 'w') as file:
+            await file.write(json.dumps(auth_data))
+
+    except asyncio.TimeoutError:
+        set_registering(False)
+        set_status(
+            f"Сервер не ответил за {registration_timeout:g} с, попробуйте ещё раз")
+        return
 
-            writer.write("\n".encode())
+    except (OSError, ValueError) as e:
+        set_registering(False)
+        set_status(f"Произошла ошибка: {e}")
+        return
 
-            data = await reader.read(100)
+    messagebox.showinfo("Регистрация", "Регистрация прошла успешно!")
+    root.destroy()
 
-            writer.write((escape_stickiness_removed(username) + "\n").encode())
 
-            response = await reader.readline()
+async def register_accounts(usernames, host, port, concurrency, registration_timeout):
+    # сервер закрывает соединение после регистрации, поэтому пул - это
+    # ограничение числа одновременных подключений
+    semaphore = asyncio.Semaphore(concurrency)
 
-            auth_data = json.loads(response.decode().strip())
+    async def register_account(username):
+        async with semaphore:
+            try:
+                async with timeout(registration_timeout):
+                    return await request_registration(username, host, port)
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                print(f"{username}: ошибка регистрации {e!r}")
 
-            writer.close()
+    accounts = await asyncio.gather(*(
+        register_account(username) for username in usernames
+    ))
+    return [
+        (username, account)
+        for username, account in zip(usernames, accounts)
+        if account
+    ]
 
-            async with aiofiles.open(auth_file_path, 'w') as file:
-                await file.write(json.dumps(auth_data))
 
-            messagebox.showinfo("Регистрация", "Регистрация прошла успешно!")
-            root.destroy()
+def get_auth_file_path(output_dir, username):
+    file_name = UNSAFE_FILE_NAME_CHARS.sub('_', username)
+    return os.path.join(output_dir, f'{file_name}.json')
+
+
+def filter_usernames(usernames, output_dir):
+    # файл аккаунта не перезаписываем: проверяем до регистрации, чтобы
+    # не регистрировать аккаунт, токен которого некуда сохранить
+    auth_file_paths = set()
+    new_usernames = []
+    for username in usernames:
+        auth_file_path = get_auth_file_path(output_dir, username)
+        if auth_file_path in auth_file_paths:
+            print(f"{username}: имя {auth_file_path} уже занято, пропускаем")
+            continue
+        if os.path.exists(auth_file_path):
+            print(f"{username}: файл {auth_file_path} уже есть, пропускаем")
+            continue
+
+        auth_file_paths.add(auth_file_path)
+        new_usernames.append(username)
+    return new_usernames
+
+
+def write_auth_files(accounts, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    for username, account in accounts:
+        auth_file_path = get_auth_file_path(output_dir, username)
+        try:
+            with open(auth_file_path, 'x') as file:
+                json.dump(account, file)
+        except FileExistsError:
+            # файл появился, пока шла регистрация: токен хотя бы покажем
+            print(
+                f"{username}: файл {auth_file_path} уже есть, "
+                f"токен {account['account_hash']}"
+            )
+
+
+async def main(settings):
+    if settings.names:
+        with open(settings.names, 'r', encoding='utf-8') as file:
+            usernames = [line.strip() for line in file if line.strip()]
+    else:
+        usernames = [
+            f'{settings.prefix}{number}'
+            for number in range(1, settings.count + 1)
+        ]
+
+    usernames = filter_usernames(usernames, settings.output_dir)
+
+    started_at = time.monotonic()
+    accounts = await register_accounts(
+        usernames,
+        settings.post_host,
+        settings.post_port,
+        settings.concurrency,
+        settings.timeout
+    )
+    # все файлы пишем одним заходом в отдельном потоке
+    await asyncio.to_thread(write_auth_files, accounts, settings.output_dir)
+
+    print(
+        f'Зарегистрировано аккаунтов: {len(accounts)} из {len(usernames)} '
+        f'за {time.monotonic() - started_at:.1f} с, '
+        f'файлы в папке {settings.output_dir}'
+    )
+
 
-    except Exception as e:
-        messagebox.showerror("Регистрация", f"Произошла ошибка: {e}")
-        root.destroy()
+if __name__ == '__main__':
+    settings = get_settings()
+    network.run_coroutine(main(settings), settings.loop)
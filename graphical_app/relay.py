@@ -0,0 +1,287 @@
+import os
+import asyncio
+import logging
+import argparse
+from collections import deque
+
+from dotenv import load_dotenv
+from anyio import create_task_group, run
+
+import queues
+import reading
+import history
+import network
+
+
+RELAY_BATCH_SIZE = 500
+SUBSCRIBER_READ_SIZE = 4096
+SLOW_POLICIES = ('drop_oldest', 'disconnect')
+
+
+def get_settings():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Share one connection to the chat between many local clients',
+    )
+
+    parser.add_argument(
+        "-gh",
+        "--get_host",
+        type=str,
+        default=os.getenv("GET_HOST"),
+        help="Chat host. For example: minechat.dvmn.org",
+    )
+
+    parser.add_argument(
+        "-gp",
+        "--get_port",
+        type=int,
+        default=os.getenv("GET_PORT"),
+        help="Chat port. For example: 5000"
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=os.getenv("RELAY_HOST", "127.0.0.1"),
+        help="Address to accept local clients on"
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=os.getenv("RELAY_PORT", 5001),
+        help="Port to accept local clients on. 0 disables TCP"
+    )
+
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        default=os.getenv("RELAY_UNIX_SOCKET"),
+        help="Also accept local clients on this Unix socket"
+    )
+
+    parser.add_argument(
+        "--buffer_size",
+        type=int,
+        default=os.getenv("RELAY_BUFFER_SIZE", 1000),
+        help="How many messages to keep for every client that reads slowly"
+    )
+
+    parser.add_argument(
+        "--slow_policy",
+        choices=SLOW_POLICIES,
+        default=os.getenv("RELAY_SLOW_POLICY", "drop_oldest"),
+        help="What to do when a client buffer is full: drop its oldest "
+             "messages or disconnect the client"
+    )
+
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=os.getenv("RELAY_BACKLOG", 100),
+        help="How many last messages to send to every new client, "
+             "as the chat server does"
+    )
+
+    parser.add_argument(
+        "--dedup_window",
+        type=int,
+        default=os.getenv("DEDUP_WINDOW", 1000),
+        help="How many last messages to remember to skip the history "
+             "the server repeats after every reconnect. 0 disables"
+    )
+
+    parser.add_argument(
+        "--server_backlog",
+        type=int,
+        default=os.getenv("SERVER_BACKLOG", history.SERVER_BACKLOG),
+        help="How many last messages the server repeats after every "
+             "reconnect. Later messages are never skipped as repeats"
+    )
+
+    parser.add_argument(
+        "-wt",
+        "--watchdog_timeout",
+        type=float,
+        default=os.getenv("WATCHDOG_TIMEOUT", 10),
+        help="Reconnect after this many seconds without server activity"
+    )
+
+    parser.add_argument(
+        "--keepalive_idle",
+        type=int,
+        default=os.getenv("KEEPALIVE_IDLE", 10),
+        help="Seconds before TCP keepalive probes start. 0 disables keepalive"
+    )
+
+    parser.add_argument(
+        "--loop",
+        choices=network.EVENT_LOOPS,
+        default=os.getenv("EVENT_LOOP", "auto"),
+        help="Event loop: uvloop if it is installed (auto), "
+             "the standard asyncio loop or uvloop"
+    )
+
+    return parser.parse_args()
+
+
+class Relay:
+    # Притворяется очередью для read_messages: каждое сообщение от сервера
+    # сразу раскладывается по буферам подписчиков
+    def __init__(self, buffer_size, slow_policy, backlog_size):
+        self.buffer_size = buffer_size
+        self.slow_policy = slow_policy
+        self.backlog = deque(maxlen=backlog_size)
+        self.subscribers = {}
+        self.dropped = 0
+        self.disconnected = 0
+
+    async def put(self, message):
+        self.put_nowait(message)
+
+    def put_nowait(self, message):
+        self.backlog.append(message)
+
+        for subscriber, writer in list(self.subscribers.items()):
+            if subscriber.full() and self.slow_policy == 'disconnect':
+                # медленный клиент переподключится и получит свежие сообщения
+                self.unsubscribe(subscriber)
+                self.disconnected += 1
+                writer.transport.abort()
+                continue
+
+            subscriber.put_nowait(message)
+
+    def subscribe(self, writer):
+        subscriber = queues.ChatQueue(self.buffer_size, 'drop_oldest')
+        for message in self.backlog:
+            subscriber.put_nowait(message)
+
+        self.subscribers[subscriber] = writer
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        if self.subscribers.pop(subscriber, None):
+            self.dropped += subscriber.dropped
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'dropped': self.dropped + sum(
+                subscriber.dropped for subscriber in self.subscribers),
+            'disconnected': self.disconnected,
+        }
+
+
+async def forward_messages(subscriber, writer):
+    while True:
+        message = await subscriber.get()
+        messages = queues.drain_queue(subscriber, message, RELAY_BATCH_SIZE)
+
+        # строки уходят клиентам в том же виде, в каком пришли от сервера
+        writer.writelines(message.raw for message in messages)
+        await writer.drain()
+
+
+async def handle_subscriber(relay, logger, reader, writer):
+    subscriber = relay.subscribe(writer)
+    logger.info('Client connected, %d in total', len(relay.subscribers))
+
+    try:
+        async with create_task_group() as task_group:
+            task_group.start_soon(forward_messages, subscriber, writer)
+
+            # клиенты чтения ничего не присылают, ждём, пока клиент отключится.
+            # Что бы клиент ни прислал, читаем кусками и выбрасываем, чтобы
+            # не копить это в памяти
+            while await reader.read(SUBSCRIBER_READ_SIZE):
+                pass
+            task_group.cancel_scope.cancel()
+
+    except Exception as error:
+        if not network.is_connection_error(error):
+            raise
+
+    finally:
+        relay.unsubscribe(subscriber)
+        writer.close()
+        logger.info('Client disconnected, %d left', len(relay.subscribers))
+
+
+async def log_upstream_status(status_updates_queue, logger):
+    while True:
+        status = await status_updates_queue.get()
+        logger.info('Upstream connection: %s', status.name)
+
+
+async def log_relay_stats(relay, logger, interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        logger.debug('Relay: %s', relay.stats())
+
+
+async def serve(settings, relay, logger):
+    async def handle_connection(reader, writer):
+        await handle_subscriber(relay, logger, reader, writer)
+
+    servers = []
+    if settings.port:
+        servers.append(await asyncio.start_server(
+            handle_connection, settings.host, settings.port))
+        logger.info('Listening on %s:%d', settings.host, settings.port)
+
+    if settings.unix_socket:
+        if os.path.exists(settings.unix_socket):
+            os.remove(settings.unix_socket)
+        servers.append(await asyncio.start_unix_server(
+            handle_connection, settings.unix_socket))
+        logger.info('Listening on %s', settings.unix_socket)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for server in servers:
+            server.close()
+
+
+async def run_relay(settings):
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s %(name)s %(levelname)s: %(message)s'
+    )
+    logger = logging.getLogger('relay')
+    watchdog_logger = logging.getLogger('watchdog')
+    relay = Relay(settings.buffer_size, settings.slow_policy, settings.backlog)
+    status_updates_queue = queues.ChatQueue(10, 'coalesce')
+    # релей историю не сохраняет, в эту очередь read_messages пишет впустую
+    history_message_queue = queues.ChatQueue(1, 'drop_oldest')
+
+    async with create_task_group() as task_group:
+        task_group.start_soon(serve, settings, relay, logger)
+        task_group.start_soon(log_upstream_status, status_updates_queue, logger)
+        task_group.start_soon(log_relay_stats, relay, logger)
+        task_group.start_soon(
+            reading.keep_reading,
+            settings.get_host,
+            settings.get_port,
+            relay,
+            history_message_queue,
+            status_updates_queue,
+            history.ReplayFilter(settings.dedup_window, settings.server_backlog),
+            watchdog_logger,
+            settings.watchdog_timeout,
+            settings.keepalive_idle
+        )
+
+
+if __name__ == '__main__':
+    try:
+        settings = get_settings()
+        run(
+            run_relay,
+            settings,
+            backend_options=network.get_backend_options(settings.loop)
+        )
+    except KeyboardInterrupt:
+        pass
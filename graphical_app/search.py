@@ -0,0 +1,169 @@
+import os
+import time
+import sqlite3
+import asyncio
+import argparse
+import threading
+
+from dotenv import load_dotenv
+
+import history
+
+
+INDEX_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def get_settings():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Search the chat history',
+    )
+
+    parser.add_argument(
+        "query",
+        type=str,
+        help="Words to search for. For example: creeper",
+    )
+
+    parser.add_argument(
+        "-hp",
+        "--history_path",
+        type=str,
+        default=os.getenv("HISTORY_PATH"),
+        help="Path to history file. For example: messages.txt"
+    )
+
+    parser.add_argument(
+        "-l",
+        "--limit",
+        type=int,
+        default=20,
+        help="How many messages to show, newest first"
+    )
+
+    return parser.parse_args()
+
+
+def make_match_query(text):
+    # каждое слово ищем как префикс, все слова должны встретиться в сообщении
+    words = text.split()
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+class HistoryIndex:
+    def __init__(self, history_path):
+        self.history_path = history_path
+        self.index_path = f'{history_path}.idx'
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS lines
+                USING fts5(text, content='', tokenize='unicode61');
+            CREATE TABLE IF NOT EXISTS progress (indexed_bytes INTEGER);
+        ''')
+
+    def get_indexed_bytes(self):
+        row = self.connection.execute(
+            'SELECT indexed_bytes FROM progress').fetchone()
+        return row[0] if row else 0
+
+    def update(self):
+        if not os.path.exists(self.history_path):
+            return 0
+
+        # поиск ждёт только вставку очередного куска, а не построение всего индекса
+        with self.lock:
+            indexed_bytes = self.get_indexed_bytes()
+            if os.path.getsize(self.history_path) < indexed_bytes:
+                # файл истории заменили или обрезали, строим индекс заново
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT INTO lines(lines) VALUES('delete-all')")
+                    self.connection.execute('DELETE FROM progress')
+                indexed_bytes = 0
+
+        lines_count = 0
+        with open(self.history_path, 'rb') as file:
+            file.seek(indexed_bytes)
+
+            while chunk := file.read(INDEX_CHUNK_SIZE):
+                # индексируем только дописанные до конца строки
+                chunk = chunk[:chunk.rfind(b'\n') + 1]
+                if not chunk:
+                    break
+
+                rows = []
+                offset = indexed_bytes
+                # делим только по \n, как и файл истории, иначе смещения
+                # разойдутся со строками файла
+                for line in chunk[:-1].split(b'\n'):
+                    text = line.decode('utf-8', 'replace').strip()
+                    if text:
+                        rows.append((offset, text))
+                    offset += len(line) + 1
+
+                with self.lock:
+                    with self.connection:
+                        self.connection.executemany(
+                            'INSERT INTO lines(rowid, text) VALUES (?, ?)', rows)
+                        self.connection.execute('DELETE FROM progress')
+                        self.connection.execute(
+                            'INSERT INTO progress VALUES (?)', (offset,))
+
+                lines_count += len(rows)
+                indexed_bytes = offset
+                file.seek(indexed_bytes)
+
+        return lines_count
+
+    def search_offsets(self, text, limit=100):
+        match_query = make_match_query(text)
+        if not match_query:
+            return []
+
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                'SELECT rowid FROM lines WHERE lines MATCH ? '
+                'ORDER BY rowid DESC LIMIT ?',
+                (match_query, limit),
+            )]
+
+    def search(self, text, limit=100):
+        return [
+            (offset, history.read_line_at(self.history_path, offset))
+            for offset in self.search_offsets(text, limit)
+        ]
+
+    def close(self):
+        self.connection.close()
+
+
+async def keep_index_updated(history_index, interval=1):
+    while True:
+        await asyncio.to_thread(history_index.update)
+        await asyncio.sleep(interval)
+
+
+def main():
+    settings = get_settings()
+    history_index = HistoryIndex(settings.history_path)
+
+    started_at = time.monotonic()
+    indexed = history_index.update()
+    if indexed:
+        print(f'Проиндексировано сообщений: {indexed}')
+
+    results = history_index.search(settings.query, settings.limit)
+    for _, line in reversed(results):
+        print(line)
+
+    print(
+        f'Найдено сообщений: {len(results)} '
+        f'за {(time.monotonic() - started_at) * 1000:.0f} мс'
+    )
+    history_index.close()
+
+
+if __name__ == '__main__':
+    main()
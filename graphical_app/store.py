@@ -0,0 +1,290 @@
+import os
+import re
+import time
+import sqlite3
+import argparse
+import datetime
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+import history
+
+
+IMPORT_CHUNK_SIZE = 8 * 1024 * 1024
+IMPORT_CHUNKS_PER_WORKER = 2
+TIMESTAMP_PATTERN = re.compile(r'^\[(\d\d\.\d\d\.\d\d \d\d:\d\d)\] ')
+
+
+def get_settings():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Import a text chat history into the SQLite archive',
+    )
+
+    parser.add_argument(
+        "-hp",
+        "--history_path",
+        type=str,
+        default=os.getenv("HISTORY_PATH"),
+        help="Path to history file. For example: messages.txt"
+    )
+
+    parser.add_argument(
+        "--history_db",
+        type=str,
+        default=os.getenv("HISTORY_DB"),
+        help="Path to the SQLite archive. By default HISTORY_PATH.db"
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="How many processes parse the history file"
+    )
+
+    return parser.parse_args()
+
+
+def parse_message(line, received_at=None):
+    # консольный клиент пишет в начало строки время: [18.10.26 17:29]
+    text = history.escape_stickiness_removed(line)
+    if not text:
+        return None
+
+    match = TIMESTAMP_PATTERN.match(text)
+    if match:
+        received_at = datetime.datetime.strptime(
+            match.group(1), '%d.%m.%y %H:%M').timestamp()
+        text = text[match.end():]
+
+    return (received_at, *history.split_author(text))
+
+
+def parse_lines(lines, offset):
+    rows = []
+    for line in lines:
+        message = parse_message(line.decode('utf-8', 'replace'))
+        if message:
+            rows.append((*message, offset))
+        offset += len(line)
+    return rows, offset
+
+
+def parse_chunk(history_path, start, end):
+    with open(history_path, 'rb') as file:
+        file.seek(start)
+        lines = history.split_lines(file.read(end - start))
+
+    rows, _ = parse_lines(lines, start)
+    return rows
+
+
+def split_into_chunks(history_path, start, end, chunk_size):
+    # границы кусков сдвигаем на конец строки, чтобы не резать сообщения
+    chunks = []
+    with open(history_path, 'rb') as file:
+        while start < end:
+            file.seek(min(start + chunk_size, end))
+            file.readline()
+            chunk_end = min(file.tell(), end)
+            chunks.append((start, chunk_end))
+            start = chunk_end
+    return chunks
+
+
+def format_message(author, body):
+    return f'{author}: {body}' if author else body
+
+
+class HistoryStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                received_at REAL,
+                author TEXT NOT NULL,
+                body TEXT NOT NULL,
+                file_offset INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_received_at
+                ON messages (received_at);
+            CREATE INDEX IF NOT EXISTS messages_author
+                ON messages (author, received_at);
+            CREATE TABLE IF NOT EXISTS progress (archived_bytes INTEGER);
+        ''')
+
+        # пока архив догоняет файл истории, новые сообщения в него не
+        # пишутся: перенос подберёт их сам, строки останутся по порядку
+        self.catching_up = None
+        self.bulk_imported = False
+        self.stopping = False
+
+    def get_archived_bytes(self):
+        row = self.connection.execute(
+            'SELECT archived_bytes FROM progress').fetchone()
+        return row[0] if row else 0
+
+    def insert_rows(self, rows, archived_bytes):
+        # одна транзакция на пачку: fsync журнала раз на пачку, а не на строку
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO messages (received_at, author, body, file_offset) '
+                'VALUES (?, ?, ?, ?)',
+                rows,
+            )
+            self.connection.execute('DELETE FROM progress')
+            self.connection.execute(
+                'INSERT INTO progress VALUES (?)', (archived_bytes,))
+
+    def add_messages(self, messages, file_offset):
+        if self.catching_up:
+            if self.bulk_imported:
+                # основной перенос закончен: дописываем то, что появилось
+                # в файле за это время, вместе с этой пачкой
+                self.import_history(self.catching_up)
+                self.catching_up = None
+            return
+
+        rows = []
+        for message in messages:
+            if message.text:
+                rows.append((
+                    message.received_at,
+                    message.author,
+                    message.body,
+                    file_offset
+                ))
+            file_offset += len(message.raw)
+
+        self.insert_rows(rows, file_offset)
+
+    def is_up_to_date(self, history_path):
+        size = os.path.getsize(history_path) if os.path.exists(history_path) else 0
+        return self.get_archived_bytes() == size
+
+    def begin_catch_up(self, history_path):
+        self.catching_up = history_path
+        self.bulk_imported = False
+
+    def catch_up(self, workers):
+        # вызывается в отдельном потоке, пишет в базу только он, пока
+        # не выставит bulk_imported
+        # если перенос упал, bulk_imported не выставляем: новые сообщения
+        # в архив не пишутся, и при следующем запуске он продолжится
+        # с того же места
+        imported = self.import_history(self.catching_up, workers)
+        self.bulk_imported = True
+        return imported
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM messages')
+            self.connection.execute('DELETE FROM progress')
+
+    def import_history(self, history_path, workers=1):
+        if not os.path.exists(history_path):
+            return 0
+
+        size = os.path.getsize(history_path)
+        archived_bytes = self.get_archived_bytes()
+        if size < archived_bytes:
+            # файл истории заменили или обрезали, переносим его заново
+            self.clear()
+            archived_bytes = 0
+
+        chunks = split_into_chunks(
+            history_path, archived_bytes, size, IMPORT_CHUNK_SIZE)
+
+        imported = 0
+        if workers > 1 and len(chunks) > 1:
+            # разбор строк идёт в нескольких процессах, а пишет в базу
+            # только этот, по порядку: у SQLite один писатель
+            # spawn, а не fork: перенос идёт в отдельном потоке программы,
+            # где работают и другие потоки, и fork мог бы унести в дочерний
+            # процесс чужие захваченные блокировки
+            executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'))
+            # в работе держим не больше IMPORT_CHUNKS_PER_WORKER кусков на
+            # процесс, иначе разобранные строки копятся в памяти, пока
+            # SQLite не успевает их вставлять
+            pending = deque()
+            chunks = iter(chunks)
+            try:
+                while True:
+                    while len(pending) < workers * IMPORT_CHUNKS_PER_WORKER:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        start, end = chunk
+                        pending.append((
+                            executor.submit(parse_chunk, history_path, start, end),
+                            end
+                        ))
+
+                    if not pending or self.stopping:
+                        break
+
+                    future, end = pending.popleft()
+                    rows = future.result()
+                    self.insert_rows(rows, end)
+                    imported += len(rows)
+            finally:
+                executor.shutdown(cancel_futures=True)
+        else:
+            for start, end in chunks:
+                if self.stopping:
+                    break
+                rows = parse_chunk(history_path, start, end)
+                self.insert_rows(rows, end)
+                imported += len(rows)
+
+        # прогресс сохраняется после каждого куска, прерванный перенос
+        # продолжится с того же места при следующем запуске
+        return imported
+
+    def last_messages(self, count):
+        rows = self.connection.execute(
+            'SELECT author, body, file_offset FROM messages '
+            'ORDER BY id DESC LIMIT ?',
+            (count,),
+        ).fetchall()
+        rows.reverse()
+
+        # те же пары (смещение в файле, строка), что и history.read_entries_before
+        return [
+            (file_offset, format_message(author, body))
+            for author, body, file_offset in rows
+        ]
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    settings = get_settings()
+    history_store = HistoryStore(
+        settings.history_db or f'{settings.history_path}.db')
+
+    started_at = time.monotonic()
+    imported = history_store.import_history(
+        settings.history_path, settings.workers)
+    history_store.close()
+
+    print(
+        f'Перенесено сообщений: {imported} '
+        f'за {time.monotonic() - started_at:.1f} с'
+    )
+
+
+if __name__ == '__main__':
+    main()